@@ -0,0 +1,375 @@
+#!/usr/bin/env python3
+
+# ~~~~~==============   BACKTESTER   ==============~~~~~
+# Replays a recorded (or synthetic) session through the strategies in bot.py
+# in simulated time, with no socket involved.
+#
+#   ./backtest.py --capture session.cap --latency-ms 1 --set XLF_trade.margin=12
+#   ./backtest.py --synthetic 600 --seed 3
+#
+# Market data comes from the session. Our orders travel to a simulated
+# exchange with a configurable latency, fill against the recorded book, and
+# the acks and fills travel back the same way.
+
+import argparse
+import heapq
+import random
+
+import bot
+from capture import INBOUND, CaptureReader
+from mock_exchange import position_limits, start_prices, xlf_basket
+from orderbook import Book
+from protocol import Dir, interned_dirs, symbols
+from ratelimit import PRIORITY_QUOTE
+from scheduler import Scheduler
+
+
+class SimClock:
+    """Simulated time, callable like time.monotonic"""
+
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class LatencyModel:
+    """One way delay between us and the exchange: a fixed part plus uniform jitter"""
+
+    def __init__(self, latency=0.001, jitter=0.0, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.random = random.Random(seed)
+
+    def delay(self):
+        if self.jitter:
+            return self.latency + self.random.random() * self.jitter
+        return self.latency
+
+
+class SimOrder:
+    __slots__ = ("order_id", "symbol", "dir", "price", "size")
+
+    def __init__(self, order_id, symbol, dir, price, size):
+        self.order_id = order_id
+        self.symbol = symbol
+        self.dir = dir
+        self.price = price
+        self.size = size
+
+
+class SimulatedExchange:
+    """Stands in for ExchangeConnection during a backtest.
+
+    Orders reach the matching logic after one latency delay and responses
+    reach the bot after another. An arriving order takes whatever the
+    recorded book shows at its price, and the rest of it rests until a later
+    book or trade crosses it."""
+
+    def __init__(self, clock, latency, risk=None):
+        self.clock = clock
+        self.latency = latency
+        # The bot's RiskEngine, checked before sending as ExchangeConnection does
+        self.risk = risk
+        # (time, sequence, handler, argument), both directions share it
+        self.events = []
+        self.sequence = 0
+        self.books = {s: Book(s) for s in symbols}
+        # Size we already took from the current book, per (symbol, dir) we took from
+        self.taken = {}
+        self.resting = {}
+        self.positions = {s: 0 for s in symbols}
+        self.cash = 0
+        self.fills = 0
+        self.messages = 0
+        self.rejects = 0
+        self.max_position = 0
+        self.on_message = None
+
+    # ~~~~~ ExchangeConnection interface ~~~~~
+
+    def send_add_message(self, order_id, symbol, dir, price, size, priority=PRIORITY_QUOTE):
+        if self.risk is not None and not self.risk.check_add(order_id, symbol, dir, size):
+            return False
+        self.messages += 1
+        self._at_exchange(self._arrive_add, SimOrder(order_id, symbol, interned_dirs[dir], price, size))
+        return True
+
+    def send_cancel_message(self, order_id):
+        self.messages += 1
+        self._at_exchange(self._arrive_cancel, order_id)
+        return True
+
+    def send_convert_message(self, order_id, symbol, dir, size):
+        if self.risk is not None and not self.risk.check_convert(order_id, symbol, dir, size):
+            return False
+        self.messages += 1
+        self._at_exchange(self._arrive_convert, (order_id, symbol, dir, size))
+        return True
+
+    def flush(self):
+        pass
+
+    # ~~~~~ event queue ~~~~~
+
+    def _push(self, when, handler, argument):
+        self.sequence += 1
+        heapq.heappush(self.events, (when, self.sequence, handler, argument))
+
+    def _at_exchange(self, handler, argument):
+        self._push(self.clock.now + self.latency.delay(), handler, argument)
+
+    def _to_bot(self, message):
+        self._push(self.clock.now + self.latency.delay(), self.on_message, message)
+
+    def next_event(self):
+        return self.events[0][0] if self.events else None
+
+    def run_next(self):
+        when, _, handler, argument = heapq.heappop(self.events)
+        self.clock.now = when
+        handler(argument)
+
+    # ~~~~~ simulated matching ~~~~~
+
+    def _arrive_add(self, order):
+        if order.order_id in self.resting:
+            self._to_bot({"type": "reject", "order_id": order.order_id, "error": "DUPLICATE_ORDER_ID"})
+            return
+        exposure = self.positions[order.symbol]
+        for other in self.resting.values():
+            if other.symbol == order.symbol and other.dir == order.dir:
+                exposure += other.size if other.dir == Dir.BUY else -other.size
+        exposure += order.size if order.dir == Dir.BUY else -order.size
+        if abs(exposure) > position_limits[order.symbol]:
+            self.rejects += 1
+            self._to_bot({"type": "reject", "order_id": order.order_id, "error": "LIMIT:POSITION"})
+            return
+        self._to_bot({"type": "ack", "order_id": order.order_id})
+        self._take(order)
+        if order.size > 0:
+            self.resting[order.order_id] = order
+        else:
+            self._to_bot({"type": "out", "order_id": order.order_id})
+
+    def _arrive_cancel(self, order_id):
+        if self.resting.pop(order_id, None) is not None:
+            self._to_bot({"type": "out", "order_id": order_id})
+
+    def _arrive_convert(self, convert):
+        order_id, symbol, dir, size = convert
+        sign = 1 if dir == Dir.BUY else -1
+        if symbol == "XLF":
+            for s, weight in xlf_basket.items():
+                self.positions[s] -= sign * weight * size // 10
+            self.cash -= 100
+        else:
+            self.positions["VALBZ" if symbol == "VALE" else "VALE"] -= sign * size
+            self.cash -= 10
+        self.positions[symbol] += sign * size
+        self._to_bot({"type": "ack", "order_id": order_id})
+
+    def _take(self, order):
+        """Fill [order] against the recorded book, level by level"""
+        book = self.books[order.symbol]
+        key = (order.symbol, order.dir)
+        taken = self.taken.get(key, 0)
+        if order.dir == Dir.BUY:
+            price, limit, step, depth = book.ask, order.price, 1, book.ask_depth
+            crossed = price is not None and price <= limit
+        else:
+            price, limit, step, depth = book.bid, order.price, -1, book.bid_depth
+            crossed = price is not None and price >= limit
+        while crossed and order.size > 0 and price != limit + step:
+            available = depth(price)
+            # Liquidity we already took stays gone until the next book message
+            used = min(taken, available)
+            taken -= used
+            size = min(order.size, available - used)
+            if size > 0:
+                self._fill(order, price, size)
+                self.taken[key] = self.taken.get(key, 0) + size
+            price += step
+
+    def _fill(self, order, price, size):
+        order.size -= size
+        sign = 1 if order.dir == Dir.BUY else -1
+        self.positions[order.symbol] += sign * size
+        self.cash -= sign * price * size
+        self.fills += 1
+        self.max_position = max(self.max_position, abs(self.positions[order.symbol]))
+        self._to_bot(
+            {"type": "fill", "order_id": order.order_id, "symbol": order.symbol,
+             "dir": order.dir, "price": price, "size": size}
+        )
+
+    def on_market_data(self, message):
+        symbol = message["symbol"]
+        if message["type"] == "book":
+            self.books[symbol].update(message["buy"], message["sell"])
+            self.taken.pop((symbol, Dir.BUY), None)
+            self.taken.pop((symbol, Dir.SELL), None)
+            for order in [o for o in self.resting.values() if o.symbol == symbol]:
+                self._take(order)
+                if order.size == 0:
+                    del self.resting[order.order_id]
+                    self._to_bot({"type": "out", "order_id": order.order_id})
+        elif message["type"] == "trade":
+            # A print at or through our price means we would have been hit
+            price = message["price"]
+            size = message["size"]
+            for order in [o for o in self.resting.values() if o.symbol == symbol]:
+                if size == 0:
+                    break
+                if (order.dir == Dir.BUY and price <= order.price) or (
+                    order.dir == Dir.SELL and price >= order.price
+                ):
+                    fill = min(size, order.size)
+                    size -= fill
+                    self._fill(order, order.price, fill)
+                    if order.size == 0:
+                        del self.resting[order.order_id]
+                        self._to_bot({"type": "out", "order_id": order.order_id})
+
+    def pnl(self):
+        """Cash plus every position marked at its last mid price"""
+        value = self.cash
+        for symbol, position in self.positions.items():
+            mid = self.books[symbol].mid()
+            if position and mid is not None:
+                value += position * mid
+        return value
+
+
+# ~~~~~============== SESSIONS ==============~~~~~
+
+def load_capture(path):
+    """Market data from a capture file as a list of (seconds, message)"""
+    reader = CaptureReader(path)
+    session = [
+        (ts / 1e9, message)
+        for ts, flow, message in reader.messages()
+        if flow == INBOUND and message["type"] in ("book", "trade")
+    ]
+    reader.close()
+    return session
+
+
+def synthetic_session(duration, rate=1000, depth=10, seed=0):
+    """Random walk books for every symbol, [rate] book messages per second"""
+    rnd = random.Random(seed)
+    fair = dict(start_prices)
+    session = []
+    t = 0.0
+    while t < duration:
+        t += rnd.expovariate(rate)
+        symbol = rnd.choice(symbols)
+        if symbol in ("VALBZ", "VALE"):
+            fair["VALBZ"] += rnd.choice((-1, 0, 0, 1))
+            fair["VALE"] = fair["VALBZ"]
+        elif symbol not in ("BOND", "XLF"):
+            fair[symbol] += rnd.choice((-1, 0, 0, 1))
+        fair["XLF"] = sum(fair[s] * w for s, w in xlf_basket.items()) // 10
+        # Sometimes the book is a little off fair, which is where the edge is
+        center = fair[symbol] + rnd.randint(-3, 3)
+        spread = rnd.randint(1, 3)
+        session.append((t, {
+            "type": "book",
+            "symbol": symbol,
+            "buy": [[center - spread - i, rnd.randint(1, 20)] for i in range(depth)],
+            "sell": [[center + spread + i, rnd.randint(1, 20)] for i in range(depth)],
+        }))
+        if rnd.random() < 0.2:
+            side = rnd.choice((-1, 1))
+            session.append((t, {"type": "trade", "symbol": symbol, "price": center + side * spread, "size": rnd.randint(1, 5)}))
+    return session
+
+
+# ~~~~~============== RUNNER ==============~~~~~
+
+def run_backtest(session, params=None, latency=None):
+    """Run bot.py's strategies over [session] and return a summary dict"""
+    if not session:
+        raise ValueError("The session has no market data")
+    clock = SimClock(session[0][0])
+    scheduler = Scheduler(clock=clock)
+    bot.reset_state()
+    exchange = SimulatedExchange(clock, latency or LatencyModel(), bot.risk)
+    if bot.history is not None:
+        bot.history.clock = clock
+    exchange.on_message = bot.handle_message
+    bot.schedule_strategies(scheduler, exchange, params)
+
+    def run_until(t):
+        while True:
+            job = scheduler.next_deadline()
+            event = exchange.next_event()
+            if event is not None and event <= t and (job is None or event < job):
+                exchange.run_next()
+            elif job is not None and job <= t:
+                clock.now = job
+                scheduler.run_due()
+            else:
+                break
+        clock.now = t
+
+    for t, message in session:
+        run_until(t)
+        exchange.on_market_data(message)
+        bot.handle_message(message)
+    run_until(session[-1][0] + 1)
+
+    return {
+        "pnl": exchange.pnl(),
+        "fills": exchange.fills,
+        "messages": exchange.messages,
+        "rejects": exchange.rejects,
+        "blocked": bot.risk.blocked,
+        "max_position": exchange.max_position,
+        "positions": dict(exchange.positions),
+        "seconds": session[-1][0] - session[0][0],
+    }
+
+
+def parse_params(settings):
+    """Turn ["XLF_trade.margin=12", ...] into {"XLF_trade": {"margin": 12}}"""
+    params = {}
+    for setting in settings:
+        name, value = setting.split("=", 1)
+        strategy, key = name.split(".", 1)
+        params.setdefault(strategy, {})[key] = float(value) if "." in value else int(value)
+    return params
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Backtest the bot's strategies offline.")
+    session_group = parser.add_mutually_exclusive_group(required=True)
+    session_group.add_argument("--capture", type=str, metavar="PATH", help="Replay a capture file.")
+    session_group.add_argument("--synthetic", type=float, metavar="SECONDS", help="Replay a synthetic session.")
+    parser.add_argument("--rate", type=float, default=1000, help="Book messages per second in synthetic sessions.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--latency-ms", type=float, default=1.0, help="One way latency to the exchange.")
+    parser.add_argument("--jitter-ms", type=float, default=0.0, help="Uniform extra latency.")
+    parser.add_argument(
+        "--set", type=str, action="append", default=[], metavar="STRATEGY.PARAM=VALUE",
+        help="Override a strategy parameter, e.g. XLF_trade.margin=12 or XLF_trade.period=0.005.",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    import time
+
+    args = parse_arguments()
+    if args.capture:
+        session = load_capture(args.capture)
+    else:
+        session = synthetic_session(args.synthetic, rate=args.rate, seed=args.seed)
+    latency = LatencyModel(args.latency_ms / 1000, args.jitter_ms / 1000, seed=args.seed)
+    start = time.perf_counter()
+    result = run_backtest(session, parse_params(args.set), latency)
+    elapsed = time.perf_counter() - start
+    for key, value in result.items():
+        print("%-13s %s" % (key, value))
+    print("%-13s %.1fx real time" % ("speed", result["seconds"] / elapsed))
@@ -0,0 +1,362 @@
+#!/usr/bin/env python3
+
+# ~~~~~============== BENCHMARKS ==============~~~~~
+# Times the hot paths of bot.py and dev_bot.py on the same fixed corpus of
+# exchange messages, so two versions of the loop can be compared objectively.
+#
+#   ./bench.py                                  # both files, print a table
+#   ./bench.py --json results.json              # also save the numbers
+#   ./bench.py --update-baseline                # store them as the baseline
+#   ./bench.py --baseline bench_baseline.json   # exit 1 on a regression
+#
+# Every stage is timed per call with perf_counter_ns (minus the timer's own
+# cost), best of several repeats to shrug off noise from the rest of the
+# machine, and then run again under tracemalloc for the bytes it allocates.
+# Nothing touches the network: reads come from a socketpair we fill
+# ourselves, and writes go into a sink that throws the bytes away.
+
+import argparse
+import contextlib
+import gc
+import importlib.util
+import json
+import os
+import random
+import socket
+import sys
+import time
+import tracemalloc
+
+here = os.path.dirname(os.path.abspath(__file__))
+symbols = ["BOND", "VALBZ", "VALE", "GS", "MS", "WFC", "XLF"]
+start_prices = {"BOND": 1000, "VALBZ": 4000, "VALE": 4000, "GS": 8000, "MS": 4000, "WFC": 4000, "XLF": 4000}
+
+
+# ~~~~~============== CORPUS ==============~~~~~
+
+def make_corpus(count=20000, depth=10, seed=0):
+    """A fixed mix of book, trade, ack and fill messages, mostly books like a real round"""
+    rnd = random.Random(seed)
+    fair = dict(start_prices)
+    messages = []
+    order_id = 0
+    for _ in range(count):
+        symbol = rnd.choice(symbols)
+        if symbol != "BOND":
+            fair[symbol] += rnd.choice((-1, 0, 1))
+        roll = rnd.random()
+        if roll < 0.8:
+            center = fair[symbol]
+            messages.append({
+                "type": "book",
+                "symbol": symbol,
+                "buy": [[center - 1 - i, rnd.randint(1, 20)] for i in range(depth)],
+                "sell": [[center + 1 + i, rnd.randint(1, 20)] for i in range(depth)],
+            })
+        elif roll < 0.9:
+            messages.append({"type": "trade", "symbol": symbol, "price": fair[symbol], "size": rnd.randint(1, 5)})
+        elif roll < 0.95:
+            order_id += 1
+            messages.append({"type": "ack", "order_id": order_id})
+        else:
+            messages.append({
+                "type": "fill", "order_id": order_id, "symbol": symbol, "dir": rnd.choice(("BUY", "SELL")),
+                "price": fair[symbol], "size": rnd.randint(1, 5),
+            })
+    return messages
+
+
+# ~~~~~============== TARGETS ==============~~~~~
+
+class NullSink:
+    def write(self, data):
+        pass
+
+    def flush(self):
+        pass
+
+
+def load(path):
+    """Import a bot file under its own name, so bot.py and dev_bot.py can sit side by side"""
+    name = "bench_" + os.path.splitext(os.path.basename(path))[0]
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def connect(module, original):
+    """An ExchangeConnection over a socketpair; returns it and the exchange's end"""
+    ours, theirs = socket.socketpair()
+    for s in (ours, theirs):
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1 << 20)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+
+    class BenchConnection(module.ExchangeConnection):
+        def _connect(self, add_socket_timeout):
+            return ours.makefile("rw", 1) if original else ours
+
+    args = argparse.Namespace(
+        exchange_hostname="localhost", port=0, add_socket_timeout=False,
+        rate_limit=10 ** 9, capture=None,
+    )
+    if original:
+        exchange = BenchConnection(args=args)
+    else:
+        exchange = BenchConnection(args=args, subscribed=module.book_symbols)
+    # Throw away our hello
+    theirs.setblocking(False)
+    with contextlib.suppress(BlockingIOError):
+        while theirs.recv(1 << 16):
+            pass
+    theirs.setblocking(True)
+    return exchange, theirs
+
+
+def null_connection(module, original):
+    """An ExchangeConnection whose writes go nowhere"""
+    exchange, _ = connect(module, original)
+    if original:
+        exchange.exchange_socket = NullSink()
+    else:
+        exchange.transport.send = lambda data: None
+    return exchange
+
+
+def reset(module, original):
+    if original:
+        module.bookdata = {s: {"sell": None, "buy": None} for s in symbols}
+        module.positions = {s: 0 for s in symbols}
+        module.orderid = 0
+    else:
+        module.reset_state()
+
+
+def stages(module, corpus):
+    """name -> (op(i), before(i) or None, wire messages per op) for one bot file"""
+    # dev_bot.py still has the handout's layout: bookdata dict, state passed in
+    original = hasattr(module, "bookdata")
+    books = [m for m in corpus if m["type"] == "book"]
+    fills = [dict(m, dir=module.Dir(m["dir"])) for m in corpus if m["type"] == "fill"]
+    lines = [json.dumps(m).encode() + b"\n" for m in corpus]
+    result = {}
+
+    # read_message, one batch of lines per op
+    exchange, theirs = connect(module, original)
+    batches = []
+    batch = []
+    for line in lines:
+        batch.append(line)
+        if sum(map(len, batch)) > 1 << 15:
+            batches.append(batch)
+            batch = []
+    if batch:
+        batches.append(batch)
+    if original:
+        expected = [len(batch) for batch in batches]
+    else:
+        # bot.py drops the books it does not trade before parsing them
+        decoder = module.Decoder(module.book_symbols)
+        expected = [sum(decoder.decode(line) is not None for line in batch) for batch in batches]
+    read = exchange.read_message
+
+    def read_before(i):
+        theirs.sendall(b"".join(batches[i % len(batches)]))
+
+    def read_op(i):
+        for _ in range(expected[i % len(batches)]):
+            read()
+
+    result["read_message"] = (read_op, read_before, len(lines) / len(batches))
+
+    if original:
+        update = module.bookdata_update
+        bookdata = module.bookdata
+        result["bookdata_update"] = (lambda i: update(bookdata, books[i % len(books)]), None, 1)
+        positions_update = module.positions_update
+        positions = module.positions
+        result["positions_update"] = (lambda i: positions_update(positions, fills[i % len(fills)]), None, 1)
+    else:
+        update = module.bookdata_update
+        result["bookdata_update"] = (lambda i: update(books[i % len(books)]), None, 1)
+        positions_update = module.positions_update
+        result["positions_update"] = (lambda i: positions_update(fills[i % len(fills)]), None, 1)
+
+    # The stages below read the books, so start them from a full set
+    for message in books[:len(symbols) * 10]:
+        if original:
+            module.bookdata_update(module.bookdata, message)
+        else:
+            module.bookdata_update(message)
+
+    average = module.bookdata_price_average
+    average_symbols = ["GS", "MS", "WFC", "XLF"]
+    result["bookdata_price_average"] = (lambda i: average(average_symbols[i & 3]), None, 1)
+
+    sink = null_connection(module, original)
+    xlf_trade = module.XLF_trade
+    # Each call sees the next book first, the way it would in the loop
+    if original:
+        before = lambda i: update(module.bookdata, books[i % len(books)])
+        result["XLF_trade"] = (lambda i: xlf_trade(sink), before, 1)
+    else:
+        before = lambda i: module.bookdata_update(books[i % len(books)])
+        flush = sink.flush
+        result["XLF_trade"] = (lambda i: (xlf_trade(sink), flush()), before, 1)
+
+    # send_add_message is the way every strategy reaches _write_message
+    send = sink.send_add_message
+    buy = module.Dir.BUY
+    if original:
+        result["_write_message"] = (lambda i: send(i, "XLF", buy, 4000, 10), None, 1)
+    else:
+        flush = sink.flush
+        result["_write_message"] = (lambda i: (send(i, "XLF", buy, 4000, 10), flush()), None, 1)
+    return result
+
+
+# ~~~~~============== MEASUREMENT ==============~~~~~
+
+def timer_overhead(calls=100000):
+    clock = time.perf_counter_ns
+    total = 0
+    for _ in range(calls):
+        start = clock()
+        total += clock() - start
+    return total / calls
+
+
+def time_stage(op, before, calls, overhead):
+    clock = time.perf_counter_ns
+    total = 0
+    for i in range(calls):
+        if before is not None:
+            before(i)
+        start = clock()
+        op(i)
+        total += clock() - start - overhead
+    return max(total, 0) / calls
+
+
+def allocations(op, before, calls):
+    """Mean bytes allocated while op runs, high-water mark above what it started with"""
+    tracemalloc.start()
+    total = 0
+    try:
+        for i in range(calls):
+            if before is not None:
+                before(i)
+            tracemalloc.reset_peak()
+            current = tracemalloc.get_traced_memory()[0]
+            op(i)
+            total += tracemalloc.get_traced_memory()[1] - current
+    finally:
+        tracemalloc.stop()
+    return total / calls
+
+
+def run(paths, calls, corpus, repeats=5):
+    overhead = timer_overhead()
+    results = {}
+    for path in paths:
+        module = load(path)
+        results[os.path.basename(path)] = target = {}
+        for name in ("read_message", "bookdata_update", "positions_update",
+                     "bookdata_price_average", "XLF_trade", "_write_message"):
+            reset(module, hasattr(module, "bookdata"))
+            ops = stages(module, corpus)
+            op, before, per_op = ops[name]
+            stage_calls = max(calls // 100, 20) if name == "read_message" else calls
+            # Warm up caches and the books before anything counts
+            time_stage(op, before, stage_calls // 10 + 1, overhead)
+            # As bot.main does once it is set up; the corpus is not garbage
+            # the stage under test should pay to walk over
+            gc.collect()
+            gc.freeze()
+            try:
+                ns = min(time_stage(op, before, stage_calls, overhead) for _ in range(repeats))
+                alloc = allocations(op, before, max(stage_calls // 10, 10))
+            finally:
+                gc.unfreeze()
+            target[name] = {"ns_per_op": ns / per_op, "alloc_bytes_per_op": alloc / per_op}
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Stages slower than the baseline by more than [threshold], as printable lines"""
+    regressions = []
+    for target, stages in results.items():
+        for name, stats in stages.items():
+            before = baseline.get(target, {}).get(name)
+            if before is None or not before["ns_per_op"]:
+                continue
+            change = stats["ns_per_op"] / before["ns_per_op"] - 1
+            stats["change"] = change
+            if change > threshold:
+                regressions.append(
+                    "%s %s: %.0f ns/op, was %.0f (+%.0f%%)"
+                    % (target, name, stats["ns_per_op"], before["ns_per_op"], change * 100)
+                )
+    return regressions
+
+
+def report(results):
+    print("%-12s %-24s %12s %14s %9s" % ("target", "stage", "ns/op", "alloc B/op", "vs base"))
+    for target, stages in results.items():
+        for name, stats in stages.items():
+            change = stats.get("change")
+            print(
+                "%-12s %-24s %12.0f %14.1f %9s"
+                % (target, name, stats["ns_per_op"], stats["alloc_bytes_per_op"],
+                   "" if change is None else "%+.0f%%" % (change * 100))
+            )
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Benchmark the bot's hot paths.")
+    parser.add_argument(
+        "--target", type=str, action="append", metavar="PATH",
+        help="Bot file to benchmark; repeat for more (default: bot.py and dev_bot.py).",
+    )
+    parser.add_argument("--calls", type=int, default=5000, help="Timed calls per stage and repeat.")
+    parser.add_argument("--repeats", type=int, default=5, help="Repeats per stage, the fastest one counts.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the message corpus.")
+    parser.add_argument("--json", type=str, metavar="PATH", help="Save the results as JSON.")
+    parser.add_argument("--baseline", type=str, default=os.path.join(here, "bench_baseline.json"), metavar="PATH")
+    parser.add_argument("--update-baseline", action="store_true", help="Store these results as the baseline.")
+    parser.add_argument(
+        "--threshold", type=float, default=0.25, help="Slowdown against the baseline that fails the run."
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    paths = args.target or [os.path.join(here, "bot.py"), os.path.join(here, "dev_bot.py")]
+    sys.path.insert(0, here)
+    corpus = make_corpus(seed=args.seed)
+    # The strategies print, which should cost what it costs but not flood the terminal
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        results = run(paths, args.calls, corpus, args.repeats)
+
+    regressions = []
+    if not args.update_baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+    report(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.update_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print("Baseline saved to", args.baseline)
+    if regressions:
+        print("Slower than the baseline by more than %.0f%%:" % (args.threshold * 100))
+        for line in regressions:
+            print("  " + line)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
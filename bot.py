@@ -1,168 +1,356 @@
 #!/usr/bin/env python3
 
 import argparse
+import atexit
+import gc
+import inspect
 from collections import defaultdict, deque
-from enum import Enum
+from functools import partial
 import time
+import selectors
 import socket
-import json
+import sys
+
+from capture import CaptureWriter
+from config import Config, ConfigWatcher
+from dispatch import Dispatcher
+from fairvalue import BasketFairValue
+try:
+    from history import History
+except ImportError:  # numpy is optional, no strategy trades on the history yet
+    History = None
+from latency import LatencyTracker
+from logger import Logger
+import multiproc
+from orderbook import TOP_PRICE, Book
+from orders import OrderIdJournal, OrderManager
+from profiler import StackSampler, StageProfiler
+from scheduler import Scheduler
+from risk import RiskEngine
+from ratelimit import PRIORITY_CANCEL, PRIORITY_QUOTE, PRIORITY_REDUCE, RateLimiter
+from protocol import (Decoder, Dir, encode_add, encode_cancel, encode_convert,
+    encode_message, frame, symbols)
+from transport import Transport
 
 team_name = "TABLETURNERS"
 
 # global variables
 # positions = defaultdict(int)
-symbols = ['BOND', 'VALBZ', 'VALE', 'GS', 'MS', 'WFC', 'XLF']
-bookdata = {s : {'sell': None, 'buy': None} for s in symbols}
+# Book messages for any other symbol are dropped before they are parsed
+book_symbols = ['VALBZ', 'VALE', 'GS', 'MS', 'WFC', 'XLF']
+books = {s : Book(s) for s in symbols}
 positions = {s : 0 for s in symbols}
-orderid = 0
+order_manager = OrderManager()
+# Checks every add and convert against the position limits before it is sent
+risk = RiskEngine()
+# 10 XLF convert to 3 BOND, 2 GS, 3 MS and 2 WFC; BOND is always worth 1000
+default_basket = {"BOND": 3, "GS": 2, "MS": 3, "WFC": 2}
+xlf_basket = BasketFairValue("XLF", default_basket, fixed={"BOND": 1000})
+# Quotes and trades per symbol for rolling statistics, when numpy is around
+history = History() if History is not None else None
+# Cheap enough to leave on, dumped when the round closes
+latency = LatencyTracker()
+# Formats and writes on its own thread, once main() starts it
+log = Logger()
+log.limit("XLF_trade", 20)
+log.limit("book", 1)
+log.limit("rate", 1)
+# Book.seq each strategy last worked from, to skip runs on an unchanged top of book
+seen_seq = {}
+# Built by reset_state() once the handlers it points at exist
+dispatcher = None
 
 def main():
-    global orderid
-
     # Setup
     args = parse_arguments()
-    exchange = ExchangeConnection(args=args)
+    reset_state(limits=args.limit, journal=OrderIdJournal(args.journal) if args.journal else None)
+    log.start()
+    # Checked before connecting: a broken file at startup is an error,
+    # later on it is only reported
+    watcher = None
+    settings = Config()
+    if args.config:
+        watcher = ConfigWatcher(args.config, strategy_settings(), log)
+        settings = watcher.load()
+        set_basket(settings.basket)
+
+    # A forked gateway shares the socket in multi-process mode, so it cannot be replaced there
+    exchange = ExchangeConnection(
+        args=args, subscribed=book_symbols, blocking=False, latency=latency, risk=risk,
+        reconnect=not args.workers,
+    )
 
     # Say hello to the exchange
     hello_message = exchange.read_message()
     print("First message from exchange:", hello_message)
+    # We may be a restart in the middle of a round
+    resync(hello_message)
+    # What exists now lives for the whole round. Decoding a batch keeps its
+    # messages alive together, which sets off collections; they should not
+    # have to walk all of this every time.
+    gc.collect()
+    gc.freeze()
+
+    if args.workers:
+        # Strategies move to worker processes, this one only reads the feed.
+        # They get the config as it was at startup, it is not reloaded there.
+        multiproc.run(sys.modules[__name__], exchange, args.workers, settings.params)
+        log.close()
+        return
 
-    timer_penny = Delaytimer(0.01, 0.006)
-    timer_ADR = Delaytimer(0.01, 0.005)
-    timer_XLF = Delaytimer(0.01, 0)
-    timer_balance = Delaytimer(1)
+    profiler = None
+    if args.profile:
+        # Has to happen before the strategies are put on the scheduler
+        profiler = StageProfiler()
+        enable_profiling(exchange, profiler)
+    sampler = None
+    if args.sample_stacks:
+        sampler = StackSampler(args.sample_stacks).start()
+    if watcher is not None:
+        watcher.start()
+
+    scheduler = Scheduler(latency=latency)
+    jobs = schedule_strategies(scheduler, exchange, settings.params)
+
+    timeout = scheduler.run_due()
     while True:
-        message = exchange.read_message()
-        bookdata_update(bookdata, message)
-        positions_update(positions, message)
-
-        if timer_penny.update():
-            # Penny Pinching on BONDS
-            # orderid += 1
-            # exchange.send_add_message(order_id=orderid, symbol="BOND", dir=Dir.BUY, price=999, size=1)
-            # orderid += 1
-            # exchange.send_add_message(order_id=orderid, symbol="BOND", dir=Dir.SELL, price=1001, size=1)
-            pass
-
-        if timer_ADR.update():
-            # Penny Pinching on ADR
-            # ADR_trade(exchange)
-            pass
-
-        if timer_XLF.update():
-            # Penny Pinching on XLF
-            XLF_trade(exchange)
-
-        if timer_balance.update():
-            ADR_balance(exchange)
-            XLF_balance(exchange)
-
-        # main_debug_print(message, see_bestprice = False)
-        if message["type"] == "close":
-            print("The round has ended")
-            break
-
-def ADR_trade(exchange, margin=5):
-    global orderid
-    valbz_bid_price = bookdata["VALBZ"]["buy"][0]
-    valbz_ask_price = bookdata["VALBZ"]["sell"][0]
-    if valbz_bid_price!=None and valbz_ask_price!=None:
-        valbz_fairvalue = (valbz_bid_price + valbz_ask_price) // 2
-
-        orderid += 1
-        exchange.send_add_message(order_id=orderid, symbol="VALE",
-         dir=Dir.SELL, price=valbz_fairvalue+margin, size=1)
-        exchange.send_cancel_message(order_id=orderid)
-
-        orderid += 1
-        exchange.send_add_message(order_id=orderid, symbol="VALE",
-         dir=Dir.BUY, price=valbz_fairvalue-margin, size=1)
-        exchange.send_cancel_message(order_id=orderid)
+        # Sleep until the exchange sends something or the next job is due,
+        # whichever comes first, so jobs run even when the market is quiet
+        exchange.wait(timeout)
+
+        for message in exchange.read_available():
+            start = time.perf_counter_ns()
+            handle_message(message)
+            end = time.perf_counter_ns()
+            latency.record("handler", message["type"], end - start)
+            latency.record("wire_to_handler", message["type"], end - exchange.transport.recv_ns)
+
+            # main_debug_print(message, see_bestprice = False)
+            if message["type"] == "close":
+                log.close()
+                print("The round has ended")
+                scheduler.report()
+                print("Orders stopped by the risk check:", risk.blocked)
+                latency.report()
+                if profiler is not None:
+                    profiler.report()
+                if sampler is not None:
+                    sampler.stop()
+                return
+
+        if watcher is not None:
+            new_settings = watcher.take()
+            if new_settings is not None:
+                # Nothing is half way through here, so the switch is all at once
+                jobs = apply_config(settings, new_settings, scheduler, exchange, jobs)
+                settings = new_settings
+        timeout = scheduler.run_due()
+        exchange.flush()
+
+# name -> (period, offset, enabled); a config file can override any of them
+strategy_defaults = {
+    # Penny Pinching on BONDS
+    # "BOND_trade": (0.01, 0.006, False),
+    # Penny Pinching on ADR
+    "ADR_trade": (0.01, 0.005, False),
+    # Penny Pinching on XLF
+    "XLF_trade": (0.01, 0, True),
+    "ADR_balance": (1, 0, True),
+    "XLF_balance": (1, 0, True),
+}
+
+def schedule_strategies(scheduler, exchange, params=None, only=None):
+    """Put every enabled strategy on the scheduler, or just those named in [only].
+    [params] maps a strategy name to keyword overrides, "period", "offset" and
+    "enabled" included. Returns the jobs by strategy name."""
+    params = params or {}
+    jobs = {}
+    for name, (period, offset, enabled) in strategy_defaults.items():
+        if only is not None and name not in only:
+            continue
+        kwargs = dict(params.get(name, {}))
+        period = kwargs.pop("period", period)
+        offset = kwargs.pop("offset", offset)
+        if not kwargs.pop("enabled", enabled):
+            continue
+        # Looked up now, so a profiled strategy is the one that runs
+        strategy = globals()[name]
+        # Settings are bound once here, the strategy reads them as plain arguments
+        job = partial(strategy, **kwargs) if kwargs else strategy
+        jobs[name] = scheduler.every(period, job, exchange, offset=offset, name=name)
+    return jobs
+
+def strategy_settings():
+    """Strategy name -> the keyword arguments it takes, for validating a config"""
+    return {
+        name: set(inspect.signature(globals()[name]).parameters) - {"exchange"}
+        for name in strategy_defaults
+    }
+
+def apply_config(old, new, scheduler, exchange, jobs):
+    """Switch from Config [old] to [new]; returns the jobs now scheduled"""
+    if new.basket != old.basket:
+        set_basket(new.basket)
+    changed = {
+        name for name in strategy_defaults
+        if new.params.get(name) != old.params.get(name)
+    }
+    for name in changed:
+        job = jobs.pop(name, None)
+        if job is not None:
+            scheduler.cancel(job)
+            # Quotes come back on the next run if it is still enabled
+            order_manager.pull(exchange, name)
+    jobs.update(schedule_strategies(scheduler, exchange, new.params, only=changed))
+    log.log("config", "Applied: %s", ", ".join(sorted(changed)) or "no strategy changes")
+    return jobs
+
+def set_basket(weights):
+    """Price XLF off [weights] (None for the default) from the books as they are"""
+    global xlf_basket
+    xlf_basket = BasketFairValue("XLF", weights or default_basket, fixed={"BOND": 1000})
+    for symbol in xlf_basket.weights:
+        if symbol != "BOND":
+            xlf_basket.on_book(symbol, books[symbol])
+    xlf_basket.on_book("XLF", books["XLF"])
+
+def enable_profiling(exchange, profiler):
+    """Route every stage of the main loop through [profiler]"""
+    global bookdata_update, positions_update, ADR_trade, ADR_balance, XLF_trade, XLF_balance
+    bookdata_update = profiler.wrap("bookdata_update", bookdata_update)
+    positions_update = profiler.wrap("positions_update", positions_update)
+    ADR_trade = profiler.wrap("ADR_trade", ADR_trade)
+    ADR_balance = profiler.wrap("ADR_balance", ADR_balance)
+    XLF_trade = profiler.wrap("XLF_trade", XLF_trade)
+    XLF_balance = profiler.wrap("XLF_balance", XLF_balance)
+    order_manager.on_message = profiler.wrap("order_manager", order_manager.on_message)
+    exchange._receive = profiler.wrap("read_message", exchange._receive)
+    exchange._write_message = profiler.wrap("_write_message", exchange._write_message)
+    exchange.flush = profiler.wrap("flush", exchange.flush)
+    # The table holds on to the handlers themselves, so point it at the wrapped ones
+    build_dispatcher()
+
+def build_dispatcher():
+    """Decide once which handlers see which (message type, symbol)"""
+    global dispatcher
+    dispatcher = Dispatcher()
+    dispatcher.subscribe(resync, "hello")
+    dispatcher.subscribe(bookdata_update, "book")
+    dispatcher.subscribe(positions_update, "fill")
+    if history is not None:
+        # After bookdata_update, so the book is already current
+        dispatcher.subscribe(record_history, "book")
+        dispatcher.subscribe(history.on_trade, "trade")
+    for kind in ("ack", "fill", "out", "reject"):
+        dispatcher.subscribe(risk.on_message, kind)
+        dispatcher.subscribe(order_manager.on_message, kind)
+
+def handle_message(message):
+    dispatcher.dispatch(message)
+
+def reset_state(limits=None, journal=None):
+    """Start over with empty books, flat positions and fresh order ids"""
+    global books, positions, order_manager, risk, xlf_basket, history
+    books = {s : Book(s) for s in symbols}
+    positions = {s : 0 for s in symbols}
+    order_manager = OrderManager(journal=journal)
+    risk = RiskEngine(limits)
+    xlf_basket = BasketFairValue("XLF", xlf_basket.weights, fixed={"BOND": 1000})
+    if history is not None:
+        history = History(clock=history.clock)
+    seen_seq.clear()
+    build_dispatcher()
+
+def resync(message: dict):
+    """Take positions from a hello message. Every resting order went away with the old connection."""
+    for entry in message["symbols"]:
+        positions[entry["symbol"]] = entry["position"]
+    order_manager.clear()
+    risk.reset(positions)
+
+def ADR_trade(exchange, margin=5, size=1):
+    book = books["VALBZ"]
+    # Same best prices as last run and both quotes still out: nothing to do
+    if (book.seq == seen_seq.get("ADR_trade")
+            and order_manager.quoting("ADR_trade", "VALE", Dir.SELL)
+            and order_manager.quoting("ADR_trade", "VALE", Dir.BUY)):
+        return
+    seen_seq["ADR_trade"] = book.seq
+    valbz_fairvalue = book.mid()
+    if valbz_fairvalue!=None:
+        # Quotes are only replaced when the price moves
+        order_manager.quote(exchange, "ADR_trade", "VALE", Dir.SELL, valbz_fairvalue+margin, size)
+        order_manager.quote(exchange, "ADR_trade", "VALE", Dir.BUY, valbz_fairvalue-margin, size)
 
 def ADR_balance(exchange, safeguard = 5):
-    global orderid
-    if positions["VALE"]>safeguard:
-        orderid += 1
-        exchange.send_add_message(order_id=orderid, symbol="VALE",
-         dir=Dir.SELL, price=bookdata["VALE"]["buy"][0], size=positions["VALE"]-safeguard)
-        exchange.send_cancel_message(order_id=orderid)
-    elif positions["VALE"]<-safeguard:
-        orderid += 1
-        exchange.send_add_message(order_id=orderid, symbol="VALE",
-         dir=Dir.BUY, price=bookdata["VALE"]["sell"][0], size=-positions["VALE"]-safeguard)
-        exchange.send_cancel_message(order_id=orderid)
-
-def XLF_trade(exchange, margin=10):
-    global orderid
-    weights = [3, 2, 3, 2]
-    n = sum(weights)
-    prices = [1000]+list(bookdata_price_average(s) for s in ['GS', 'MS', 'WFC'])
-    if None in prices:
-        print("There is a None here!")
+    book = books["VALE"]
+    sell_size, buy_size = 0, 0
+    # Never ask for more than is resting at the best price
+    if positions["VALE"]>safeguard and book.bid!=None:
+        sell_size = min(positions["VALE"]-safeguard, book.bid_size)
+    elif positions["VALE"]<-safeguard and book.ask!=None:
+        buy_size = min(-positions["VALE"]-safeguard, book.ask_size)
+    # A size of 0 pulls whatever is left once the position is back in range
+    order_manager.quote(exchange, "ADR_balance", "VALE", Dir.SELL, book.bid, sell_size, PRIORITY_REDUCE)
+    order_manager.quote(exchange, "ADR_balance", "VALE", Dir.BUY, book.ask, buy_size, PRIORITY_REDUCE)
+
+def XLF_trade(exchange, margin=10, size=10):
+    fairvalue = xlf_basket.fair
+    if fairvalue == None:
+        log.log("XLF_trade", "There is a None here!")
         return
-    fairvalue = int(sum(prices[i]*weights[i]/n for i in range(4)))
-
-    print("Fair value:",fairvalue, bookdata["XLF"])
-    orderid += 1
-    exchange.send_add_message(order_id=orderid, symbol="XLF",
-     dir=Dir.SELL, price=fairvalue+margin, size=10)
-    exchange.send_cancel_message(order_id=orderid)
+    # Nothing to recompute unless the basket moved or one of our quotes is gone
+    if (not xlf_basket.dirty
+            and order_manager.quoting("XLF_trade", "XLF", Dir.SELL)
+            and order_manager.quoting("XLF_trade", "XLF", Dir.BUY)):
+        return
+    xlf_basket.dirty = False
 
-    orderid += 1
-    exchange.send_add_message(order_id=orderid, symbol="XLF",
-     dir=Dir.BUY, price=fairvalue-margin, size=10)
-    exchange.send_cancel_message(order_id=orderid)
+    log.log("XLF_trade", "Fair value: %s %s %s", fairvalue, books["XLF"].bid, books["XLF"].ask)
+    order_manager.quote(exchange, "XLF_trade", "XLF", Dir.SELL, fairvalue+margin, size)
+    order_manager.quote(exchange, "XLF_trade", "XLF", Dir.BUY, fairvalue-margin, size)
 
 def XLF_balance(exchange, safeguard = 50):
-    global orderid
-    if positions["XLF"]>safeguard:
-        orderid += 1
-        exchange.send_add_message(order_id=orderid, symbol="XLF",
-         dir=Dir.SELL, price=bookdata["XLF"]["buy"][0], size=positions["XLF"]-safeguard)
-        exchange.send_cancel_message(order_id=orderid)
-    elif positions["XLF"]<-safeguard:
-        orderid += 1
-        exchange.send_add_message(order_id=orderid, symbol="XLF",
-         dir=Dir.BUY, price=bookdata["XLF"]["sell"][0], size=-positions["XLF"]-safeguard)
-        exchange.send_cancel_message(order_id=orderid)
+    book = books["XLF"]
+    sell_size, buy_size = 0, 0
+    if positions["XLF"]>safeguard and book.bid!=None:
+        sell_size = min(positions["XLF"]-safeguard, book.bid_size)
+    elif positions["XLF"]<-safeguard and book.ask!=None:
+        buy_size = min(-positions["XLF"]-safeguard, book.ask_size)
+    order_manager.quote(exchange, "XLF_balance", "XLF", Dir.SELL, book.bid, sell_size, PRIORITY_REDUCE)
+    order_manager.quote(exchange, "XLF_balance", "XLF", Dir.BUY, book.ask, buy_size, PRIORITY_REDUCE)
 
 def bookdata_price_average(symbol):
-    bid_price = bookdata[symbol]["buy"][0]
-    ask_price = bookdata[symbol]["sell"][0]
-    if bid_price!=None and ask_price!=None:
-        return (bid_price + ask_price) // 2
-    return None
-
-def positions_update(positions: dict, message: dict):
-    if message["type"] == "fill":
-        if message["dir"] == "BUY":
-            positions[message["symbol"]] += message["size"] # increase number positions
-        elif message["dir"] == "SELL":
-            positions[message["symbol"]] -= message["size"] # decrease number positions
-        # print("positions: ", positions)
-
-def bookdata_update(bookdata: dict, message: dict):
-    if message["type"] == "book":
-        if message["buy"]:
-            bookdata[message["symbol"]]["buy"] = message["buy"][0] # get best bid
-        if message["sell"]:
-            bookdata[message["symbol"]]["sell"] = message["sell"][0] # get best ask
-        # print("bookdata: ", bookdata)
-
-class Delaytimer:
-    def __init__(self, delay, offset = 0):
-        self.delay = delay
-        self.wait_until = time.time() + self.delay+offset
-
-    def update(self):
-        if self.wait_until < time.time():
-            self.wait_until = time.time() + self.delay
-            return True
-        return False
+    return books[symbol].mid()
+
+# Handlers below are only ever called by the dispatcher for their own message type
+
+def positions_update(message: dict):
+    if message["dir"] == "BUY":
+        positions[message["symbol"]] += message["size"] # increase number positions
+    elif message["dir"] == "SELL":
+        positions[message["symbol"]] -= message["size"] # decrease number positions
+    # print("positions: ", positions)
+
+def bookdata_update(message: dict):
+    book = books[message["symbol"]]
+    # keep every level; mids only move with a best price
+    if book.update(message["buy"], message["sell"]) & TOP_PRICE:
+        xlf_basket.on_book(message["symbol"], book)
+    # print("bid/ask: ", books[message["symbol"]].bid, books[message["symbol"]].ask)
+
+def record_history(message: dict):
+    symbol = message["symbol"]
+    book = books[symbol]
+    # Rows only hold best prices, so a book that kept them adds nothing
+    if not book.changes & TOP_PRICE:
+        return
+    history.on_book(symbol, book)
+    if symbol in xlf_basket.weights and xlf_basket.fair is not None:
+        history.on_value("XLF_basket", xlf_basket.fair)
 
 def main_debug_print(message, see_bestprice):
     vale_bid_price, vale_ask_price = None, None
-    vale_last_print_time = time.time()
     # Some of the message types below happen infrequently and contain
     # important information to help you understand what your bot is doing,
     # so they are printed in full. We recommend not always printing every
@@ -170,13 +358,13 @@ def main_debug_print(message, see_bestprice):
     # your code handle the messages and just print the information
     # important for you!
     if message["type"] == "close":
-        print("The round has ended")
+        log.log("exchange", "The round has ended")
     elif message["type"] == "error":
-        print(message)
+        log.log("exchange", "%s", message)
     elif message["type"] == "reject":
-        print(message)
+        log.log("exchange", "%s", message)
     elif message["type"] == "fill":
-        print(message)
+        log.log("exchange", "%s", message)
     elif message["type"] == "book":
         if message["symbol"] == "VALE":
 
@@ -187,17 +375,9 @@ def main_debug_print(message, see_bestprice):
             vale_bid_price = best_price("buy")
             vale_ask_price = best_price("sell")
 
-            now = time.time()
-
-            if now > vale_last_print_time + 1:
-                vale_last_print_time = now
-                if see_bestprice:
-                    print(
-                        {
-                            "vale_bid_price": vale_bid_price,
-                            "vale_ask_price": vale_ask_price,
-                        }
-                    )
+            # The "book" category lets one of these through per second
+            if see_bestprice:
+                log.log("book", "vale_bid_price %s vale_ask_price %s", vale_bid_price, vale_ask_price)
 
 
 # ~~~~~============== PROVIDED CODE ==============~~~~~
@@ -207,59 +387,197 @@ def main_debug_print(message, see_bestprice):
 # do need to change anything below this line, please feel free to
 
 
-class Dir(str, Enum):
-    BUY = "BUY"
-    SELL = "SELL"
-
-
 class ExchangeConnection:
-    def __init__(self, args):
+    def __init__(self, args, subscribed=None, blocking=True, latency=None, risk=None, reconnect=False):
         self.message_timestamps = deque(maxlen=500)
         self.exchange_hostname = args.exchange_hostname
         self.port = args.port
-        self.exchange_socket = self._connect(add_socket_timeout=args.add_socket_timeout)
-
-        self._write_message({"type": "hello", "team": team_name.upper()})
+        # Path of a local gateway's socket to use instead of the exchange itself
+        self.gateway = getattr(args, "gateway", None)
+        # Same rule as the blocking socket timeout, but checked in wait()
+        self.socket_timeout = 5 if args.add_socket_timeout else None
+        self.add_socket_timeout = args.add_socket_timeout
+        # Whether a dead connection is replaced rather than raised, and for how long we try
+        self.reconnect = reconnect
+        self.reconnect_for = 10
+        self.reconnects = 0
+        self.decoder = Decoder(subscribed)
+        self.latency = latency
+        self.risk = risk
+        self.messages = deque()
+        # Orders wait here for rate limit budget, then go out together in flush()
+        self.limiter = RateLimiter(args.rate_limit)
+        self.outbound = bytearray()
+        self.capture = None
+        if args.capture:
+            # Every line in and out, written by a background thread
+            self.capture = CaptureWriter(args.capture)
+            atexit.register(self.capture.close)
+        self.selector = selectors.DefaultSelector()
+        self._open(blocking)
+
+    def _open(self, blocking):
+        self.exchange_socket = self._connect(add_socket_timeout=self.add_socket_timeout)
+        self.transport = Transport(self.exchange_socket, blocking=blocking, framed=self.gateway is not None)
+        self.transport.recv_ns = time.perf_counter_ns()
+        self.selector.register(self.exchange_socket, selectors.EVENT_READ)
+
+        # Straight out, not through the limiter: after a reconnect its bucket
+        # may be empty, and nothing else can happen until the hello is answered
+        self._send_now(encode_message({"type": "hello", "team": team_name.upper()}))
+        self.transport.send(self.outbound)
+        self.outbound.clear()
+        self.transport.flush()
+
+    def _reconnect(self, error):
+        """Replace a dead connection. The exchange answers with a new hello,
+        which reaches the handlers like any other message."""
+        if not self.reconnect:
+            raise error
+        log.log("exchange", "Lost the exchange connection (%s), reconnecting", error)
+        self.selector.unregister(self.exchange_socket)
+        self.exchange_socket.close()
+        # Whatever was queued belonged to orders the exchange has already pulled
+        self.limiter.clear()
+        self.outbound.clear()
+        self.messages.clear()
+        deadline = time.monotonic() + self.reconnect_for
+        while True:
+            try:
+                self._open(self.transport.blocking)
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+        # Nothing runs on the old state: the hello comes first out of read_available()
+        while not self.messages:
+            if not self.selector.select(self.reconnect_for):
+                raise socket.timeout("No hello from the exchange after reconnecting")
+            if self.transport.fill():
+                self._decode_lines()
+        self.reconnects += 1
 
     def read_message(self):
         """Read a single message from the exchange"""
-        message = json.loads(self.exchange_socket.readline())
-        if "dir" in message:
-            message["dir"] = Dir(message["dir"])
-        return message
+        while not self.messages:
+            # Never wait on the exchange with our own orders still unsent
+            self.flush()
+            if not self.transport.blocking:
+                self.wait(None)
+            self._receive()
+        return self.messages.popleft()
+
+    def read_available(self):
+        """Yield the messages that have already arrived, without waiting for more.
+        Only meant for non-blocking connections."""
+        # One recv per call, so a burst of market data cannot starve the timers
+        self._receive()
+        messages = self.messages
+        while messages:
+            yield messages.popleft()
+
+    def _receive(self):
+        try:
+            if self.transport.fill():
+                self._decode_lines()
+        except OSError as error:
+            self._reconnect(error)
+
+    def wait(self, timeout):
+        """Wait up to [timeout] seconds (forever if None) for data from the exchange"""
+        if self.messages:
+            return True
+        self.flush()
+        if self.socket_timeout is not None:
+            silent = (time.perf_counter_ns() - self.transport.recv_ns) / 1e9
+            if silent > self.socket_timeout:
+                self._reconnect(socket.timeout("No data from the exchange for %d seconds" % self.socket_timeout))
+                return True
+            remaining = self.socket_timeout - silent
+            timeout = remaining if timeout is None else min(timeout, remaining)
+        release = self.limiter.next_release()
+        if release is not None:
+            # Wake up again when queued orders can go out
+            timeout = release if timeout is None else min(timeout, release)
+        return bool(self.selector.select(timeout))
+
+    def _decode_lines(self):
+        # A single recv usually carries many lines, decode all of them at once
+        decode = self.decoder.decode
+        capture = self.capture
+        latency = self.latency
+        recv_ns = self.transport.recv_ns
+        for line in self.transport.records():
+            if capture is not None:
+                capture.inbound(recv_ns, line)
+            if latency is None:
+                message = decode(line)
+            else:
+                start = time.perf_counter_ns()
+                message = decode(line)
+                if message is not None:
+                    latency.record("decode", message["type"], time.perf_counter_ns() - start)
+            if message is not None:
+                self.messages.append(message)
 
     def send_add_message(
-        self, order_id: int, symbol: str, dir: Dir, price: int, size: int
+        self, order_id: int, symbol: str, dir: Dir, price: int, size: int, priority=PRIORITY_QUOTE
     ):
-        """Add a new order"""
-        self._write_message(
-            {
-                "type": "add",
-                "order_id": order_id,
-                "symbol": symbol,
-                "dir": dir,
-                "price": price,
-                "size": size,
-            }
-        )
+        """Add a new order.
+        Returns False if it would break a position limit and was not sent."""
+        if self.risk is not None and not self.risk.check_add(order_id, symbol, dir, size):
+            return False
+        self._write_message(encode_add(order_id, symbol, dir, price, size), priority, order_id)
+        return True
 
     def send_convert_message(self, order_id: int, symbol: str, dir: Dir, size: int):
-        """Convert between related symbols"""
-        self._write_message(
-            {
-                "type": "convert",
-                "order_id": order_id,
-                "symbol": symbol,
-                "dir": dir,
-                "size": size,
-            }
-        )
+        """Convert between related symbols.
+        Returns False if it would break a position limit and was not sent."""
+        if self.risk is not None and not self.risk.check_convert(order_id, symbol, dir, size):
+            return False
+        self._write_message(encode_convert(order_id, symbol, dir, size), PRIORITY_REDUCE)
+        return True
 
     def send_cancel_message(self, order_id: int):
-        """Cancel an existing order"""
-        self._write_message({"type": "cancel", "order_id": order_id})
+        """Cancel an existing order.
+        Returns False if the add had not been sent yet and was dropped instead."""
+        if self.limiter.withdraw(order_id):
+            if self.risk is not None:
+                self.risk.release(order_id)
+            return False
+        self._write_message(encode_cancel(order_id), PRIORITY_CANCEL)
+        return True
+
+    def flush(self):
+        """Send every message the rate limit allows right now in a single write"""
+        if self.limiter.queued:
+            self.limiter.release(time.monotonic(), self._send_now)
+        try:
+            if self.outbound:
+                if self.latency is None:
+                    self.transport.send(self.outbound)
+                    self.transport.flush()
+                else:
+                    start = time.perf_counter_ns()
+                    self.transport.send(self.outbound)
+                    self.transport.flush()
+                    end = time.perf_counter_ns()
+                    # From the last bytes we received to our orders leaving
+                    self.latency.record("tick_to_trade", "flush", start - self.transport.recv_ns)
+                    self.latency.record("send", "flush", end - start)
+                self.outbound.clear()
+            elif self.transport.out:
+                # Left over from a write the socket could not take all of
+                self.transport.flush()
+        except OSError as error:
+            self._reconnect(error)
 
     def _connect(self, add_socket_timeout):
+        if self.gateway is not None:
+            s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            s.connect(self.gateway)
+            return s
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
         if add_socket_timeout:
@@ -268,26 +586,49 @@ class ExchangeConnection:
             # exchange.
             s.settimeout(5)
         s.connect((self.exchange_hostname, self.port))
-        return s.makefile("rw", 1)
+        return s
+
+    def _write_message(self, data, priority=PRIORITY_QUOTE, key=None):
+        self.limiter.submit(priority, data, key)
 
-    def _write_message(self, message):
-        json.dump(message, self.exchange_socket)
-        self.exchange_socket.write("\n")
+    def _send_now(self, data):
+        self.outbound += data if self.gateway is None else frame(data)
+        if self.capture is not None:
+            self.capture.outbound(time.perf_counter_ns(), data)
 
         now = time.time()
         self.message_timestamps.append(now)
         if len(
             self.message_timestamps
         ) == self.message_timestamps.maxlen and self.message_timestamps[0] > (now - 1):
-            print(
+            log.log(
+                "rate",
                 "WARNING: You are sending messages too frequently. The exchange will start ignoring your messages. Make sure you are not sending a message in response to every exchange message."
             )
 
 
-def parse_arguments():
-    test_exchange_port_offsets = {"prod-like": 0, "slower": 1, "empty": 2}
+def parse_workers(setting):
+    names = setting.split(",")
+    for name in names:
+        if name not in strategy_defaults:
+            raise argparse.ArgumentTypeError(
+                "no strategy called %r, expected some of %s" % (name, ",".join(strategy_defaults))
+            )
+    return names
 
-    parser = argparse.ArgumentParser(description="Trade on an ETC exchange!")
+
+def parse_limit(setting):
+    symbol, _, size = setting.partition("=")
+    if symbol not in symbols or not size.isdigit():
+        raise argparse.ArgumentTypeError("expected SYMBOL=SIZE, got %r" % setting)
+    return symbol, int(size)
+
+
+test_exchange_port_offsets = {"prod-like": 0, "slower": 1, "empty": 2}
+
+
+def add_exchange_arguments(parser, gateway=True):
+    """Where to connect, shared with the tools that talk to the exchange"""
     exchange_address_group = parser.add_mutually_exclusive_group(required=True)
     exchange_address_group.add_argument(
         "--production", action="store_true", help="Connect to the production exchange."
@@ -303,10 +644,22 @@ def parse_arguments():
     exchange_address_group.add_argument(
         "--specific-address", type=str, metavar="HOST:PORT", help=argparse.SUPPRESS
     )
+    if gateway:
+        exchange_address_group.add_argument(
+            "--gateway", type=str, metavar="PATH", help="Connect through a local gateway's Unix socket."
+        )
 
-    args = parser.parse_args()
-    args.add_socket_timeout = True
+    parser.add_argument(
+        "--capture", type=str, metavar="PATH", help="Record every message to a binary capture file."
+    )
 
+    # Messages per second we allow ourselves, the exchange starts ignoring us past 500
+    parser.add_argument("--rate-limit", type=int, default=500, help=argparse.SUPPRESS)
+
+
+def resolve_exchange_address(args):
+    args.add_socket_timeout = True
+    args.exchange_hostname = args.port = None
     if args.production:
         args.exchange_hostname = "production"
         args.port = 25000
@@ -318,7 +671,39 @@ def parse_arguments():
     elif args.specific_address:
         args.exchange_hostname, port = args.specific_address.split(":")
         args.port = int(port)
+    return args
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Trade on an ETC exchange!")
+    add_exchange_arguments(parser)
+
+    parser.add_argument(
+        "--profile", action="store_true", help="Print CPU time per main loop stage when the round ends."
+    )
+    parser.add_argument(
+        "--sample-stacks", type=str, metavar="PATH",
+        help="Sample the main thread's stack and write collapsed stacks for a flamegraph.",
+    )
+    parser.add_argument(
+        "--workers", type=parse_workers, action="append", metavar="STRATEGY,...",
+        help="Run these strategies in their own process; repeat for more processes.",
+    )
+    parser.add_argument(
+        "--journal", type=str, default="order_ids.journal", metavar="PATH",
+        help="File keeping the order id high-water mark across restarts; empty to disable.",
+    )
+    parser.add_argument(
+        "--limit", type=parse_limit, action="append", metavar="SYMBOL=SIZE",
+        help="Tighter position limit for the risk check than the exchange's own.",
+    )
+    parser.add_argument(
+        "--config", type=str, metavar="PATH",
+        help="JSON strategy settings, reloaded whenever the file changes (see config.py).",
+    )
 
+    args = resolve_exchange_address(parser.parse_args())
+    args.limit = dict(args.limit or ())
     return args
 
 
@@ -0,0 +1,209 @@
+import json
+import mmap
+from queue import SimpleQueue
+import struct
+import threading
+import time
+
+from protocol import symbols
+
+# ~~~~~============== CAPTURE FORMAT ==============~~~~~
+# A capture file is a 24 byte header followed by 24 byte records, appended in
+# the order messages crossed the wire.
+#
+# Every message starts with an event record:
+#   kind B, flow B (0 in, 1 out), symbol B, dir B, order_id i, ts_ns q, price i, size i
+# Book and hello messages are followed by level records:
+#   kind B (always LEVEL), pair count B, 2 pad bytes, five (price H, size h) pairs
+# A book event stores the number of buy levels in order_id and sell levels in
+# size. A hello event stores the number of symbols in size, and its pairs are
+# (symbol index, position). For reject and error messages the price field
+# holds an index into [errors].
+#
+# Since the kind is always the first byte, the whole file can be walked with
+# one struct.iter_unpack and level records skipped by kind.
+#
+# Timestamps are time.perf_counter_ns(); the header records the wall clock
+# at the same moment so they can be turned back into real times.
+
+MAGIC = b"ETCCAP02"
+HEADER = struct.Struct("<8sqq")
+EVENT = struct.Struct("<BBBBiqii")
+LEVELS = struct.Struct("<BBxx" + "Hh" * 5)
+RECORD_SIZE = 24
+LEVELS_PER_RECORD = 5
+LEVEL = 254
+
+INBOUND = 0
+OUTBOUND = 1
+
+kinds = [
+    "hello", "open", "close", "error", "book", "trade", "ack", "reject", "fill", "out",
+    "add", "cancel", "convert",
+]
+kind_codes = {k: i for i, k in enumerate(kinds)}
+symbol_codes = {s: i for i, s in enumerate(symbols)}
+NO_SYMBOL = 255
+dir_codes = {None: 0, "BUY": 1, "SELL": 2}
+dirs = [None, "BUY", "SELL"]
+errors = [
+    "", "MALFORMED_MESSAGE", "DUPLICATE_ORDER_ID", "UNKNOWN_SYMBOL", "INVALID_PRICE",
+    "INVALID_SIZE", "LIMIT:POSITION", "RATE_LIMITED", "TRADING_CLOSED", "UNKNOWN_ORDER",
+]
+error_codes = {e: i for i, e in enumerate(errors)}
+_no_levels = ()
+
+
+def pack_message(out, ts, flow, message):
+    """Append the records for one decoded message to the bytearray [out]"""
+    kind = kind_codes.get(message.get("type"))
+    if kind is None:
+        return
+    symbol = symbol_codes.get(message.get("symbol"), NO_SYMBOL)
+    dir = dir_codes.get(message.get("dir"), 0)
+    order_id = message.get("order_id") or 0
+    price = message.get("price") or 0
+    size = message.get("size") or 0
+    pairs = _no_levels
+    if kind == kind_codes["book"]:
+        order_id = len(message["buy"])
+        size = len(message["sell"])
+        pairs = message["buy"] + message["sell"]
+    elif kind == kind_codes["hello"]:
+        # Our own hello only carries the team name
+        pairs = [
+            [symbol_codes.get(s["symbol"], NO_SYMBOL), s["position"]] for s in message.get("symbols", ())
+        ]
+        size = len(pairs)
+    elif kind == kind_codes["reject"] or kind == kind_codes["error"]:
+        price = error_codes.get(message.get("error"), 0)
+
+    out += EVENT.pack(kind, flow, symbol, dir, order_id, ts, price, size)
+    for i in range(0, len(pairs), LEVELS_PER_RECORD):
+        chunk = pairs[i:i + LEVELS_PER_RECORD]
+        values = [LEVEL, len(chunk)]
+        for p, s in chunk:
+            values.append(p)
+            values.append(max(-32768, min(s, 32767)))
+        values.extend((0, 0) * (LEVELS_PER_RECORD - len(chunk)))
+        out += LEVELS.pack(*values)
+
+
+class CaptureWriter:
+    """Records raw inbound and outbound lines with their timestamps.
+
+    The hot path only copies the line onto a queue. Parsing and packing
+    happen on a background thread, which writes in batches."""
+
+    def __init__(self, path):
+        self.file = open(path, "wb")
+        self.file.write(HEADER.pack(MAGIC, time.time_ns(), time.perf_counter_ns()))
+        self.queue = SimpleQueue()
+        self.thread = threading.Thread(target=self._run, name="capture", daemon=True)
+        self.thread.start()
+
+    def inbound(self, ts, line):
+        self.queue.put((ts, INBOUND, bytes(line)))
+
+    def outbound(self, ts, data):
+        self.queue.put((ts, OUTBOUND, data))
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+    def _run(self):
+        out = bytearray()
+        queue = self.queue
+        running = True
+        while running:
+            item = queue.get()
+            # Pack everything that is already queued, then write it in one go
+            while True:
+                if item is None:
+                    running = False
+                    break
+                ts, flow, line = item
+                try:
+                    pack_message(out, ts, flow, json.loads(line))
+                except (ValueError, KeyError, TypeError, struct.error):
+                    pass
+                if queue.empty():
+                    break
+                item = queue.get()
+            if out:
+                self.file.write(out)
+                out.clear()
+        self.file.close()
+
+
+class CaptureReader:
+    """Memory maps a capture file and walks its records without parsing any JSON"""
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.wall_ns, self.start_ns = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            raise ValueError("%s is not a capture file" % path)
+        # A capture still being written can end part way through a record
+        self.end = HEADER.size + (len(self.map) - HEADER.size) // RECORD_SIZE * RECORD_SIZE
+
+    def records(self):
+        """Yield (index, record) for every event record, skipping level records.
+        Records are (kind, flow, symbol, dir, order_id, ts, price, size) with codes
+        left as small integers; pass the index to levels() for book and hello pairs."""
+        body = memoryview(self.map)[HEADER.size:self.end]
+        for index, record in enumerate(EVENT.iter_unpack(body)):
+            if record[0] != LEVEL:
+                yield index, record
+
+    def levels(self, index):
+        """Flat (price, size, price, size, ...) tuple for the event at [index]"""
+        unpack = LEVELS.unpack_from
+        offset = HEADER.size + (index + 1) * RECORD_SIZE
+        pairs = ()
+        while offset < self.end:
+            record = unpack(self.map, offset)
+            if record[0] != LEVEL:
+                break
+            pairs += record[2:2 + 2 * record[1]]
+            offset += RECORD_SIZE
+        return pairs
+
+    def messages(self):
+        """Yield (ts, flow, message) with messages rebuilt as protocol dicts"""
+        for index, (kind, flow, symbol, dir, order_id, ts, price, size) in self.records():
+            kind = kinds[kind]
+            message = {"type": kind}
+            if symbol != NO_SYMBOL:
+                message["symbol"] = symbols[symbol]
+            if kind == "book":
+                levels = self.levels(index)
+                pairs = [[levels[i], levels[i + 1]] for i in range(0, len(levels), 2)]
+                message["buy"] = pairs[:order_id]
+                message["sell"] = pairs[order_id:]
+            elif kind == "hello":
+                levels = self.levels(index)
+                message["symbols"] = [
+                    {"symbol": symbols[levels[i]], "position": levels[i + 1]}
+                    for i in range(0, len(levels), 2)
+                ]
+            elif kind == "reject" or kind == "error":
+                if kind == "reject":
+                    message["order_id"] = order_id
+                message["error"] = errors[price]
+            else:
+                if dir:
+                    message["dir"] = dirs[dir]
+                if kind not in ("open", "close", "trade"):
+                    message["order_id"] = order_id
+                if kind in ("add", "fill", "trade"):
+                    message["price"] = price
+                if kind in ("add", "convert", "fill", "trade"):
+                    message["size"] = size
+            yield ts, flow, message
+
+    def close(self):
+        self.map.close()
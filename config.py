@@ -0,0 +1,176 @@
+from collections import deque
+import json
+import math
+import os
+import threading
+
+from protocol import symbols
+
+# A strategy config file is JSON, every key optional:
+#
+#   {
+#     "strategies": {
+#       "XLF_trade": {"enabled": true, "period": 0.01, "margin": 12, "size": 10},
+#       "ADR_trade": {"enabled": false},
+#       "XLF_balance": {"safeguard": 40}
+#     },
+#     "basket": {"BOND": 3, "GS": 2, "MS": 3, "WFC": 2}
+#   }
+#
+# Anything left out keeps the default from the code.
+
+# Keys that go to the scheduler rather than to the strategy itself
+schedule_keys = ("enabled", "period", "offset")
+
+
+class Config:
+    """A validated configuration in the shape the bot uses directly:
+    [params] as schedule_strategies() takes them, [basket] as weights for
+    BasketFairValue (None to keep the code's)."""
+
+    __slots__ = ("params", "basket")
+
+    def __init__(self, params=None, basket=None):
+        self.params = params or {}
+        self.basket = basket
+
+
+def _number(where, value):
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+        raise ValueError("%s: expected a number, got %r" % (where, value))
+    return value
+
+
+def compile_config(data, strategies, etf="XLF"):
+    """Check [data] (a parsed config file) against [strategies], which maps
+    each strategy name to the keyword arguments it takes, and turn it into
+    a Config. Raises ValueError naming the first thing that is wrong."""
+    if not isinstance(data, dict):
+        raise ValueError("expected a JSON object at the top level")
+    unknown = set(data) - {"strategies", "basket"}
+    if unknown:
+        raise ValueError("unknown section %r" % sorted(unknown)[0])
+
+    sections = data.get("strategies", {})
+    if not isinstance(sections, dict):
+        raise ValueError("strategies: expected an object")
+    params = {}
+    for name, settings in sections.items():
+        if name not in strategies:
+            raise ValueError("strategies: no strategy called %r" % name)
+        if not isinstance(settings, dict):
+            raise ValueError("strategies.%s: expected an object" % name)
+        compiled = params[name] = {}
+        for key, value in settings.items():
+            where = "strategies.%s.%s" % (name, key)
+            if key == "enabled":
+                if not isinstance(value, bool):
+                    raise ValueError("%s: expected true or false, got %r" % (where, value))
+            elif key == "period":
+                if _number(where, value) <= 0:
+                    raise ValueError("%s: must be positive" % where)
+            elif key == "offset":
+                if _number(where, value) < 0:
+                    raise ValueError("%s: must not be negative" % where)
+            elif key not in strategies[name]:
+                raise ValueError("%s: %s takes no such setting" % (where, name))
+            elif key == "size":
+                if isinstance(value, bool) or not isinstance(value, int) or value <= 0:
+                    raise ValueError("%s: expected a positive whole number, got %r" % (where, value))
+            elif isinstance(value, bool) or not isinstance(value, int) or value < 0:
+                # Margins and safeguards end up in integer prices and sizes on the wire
+                raise ValueError("%s: expected a non-negative whole number, got %r" % (where, value))
+            compiled[key] = value
+
+    basket = data.get("basket")
+    if basket is not None:
+        if not isinstance(basket, dict) or not basket:
+            raise ValueError("basket: expected an object of symbol weights")
+        for symbol, weight in basket.items():
+            if symbol not in symbols or symbol == etf:
+                raise ValueError("basket: %r cannot be part of the %s basket" % (symbol, etf))
+            if isinstance(weight, bool) or not isinstance(weight, int) or weight <= 0:
+                raise ValueError("basket.%s: expected a positive whole number, got %r" % (symbol, weight))
+        basket = dict(basket)
+    return Config(params, basket)
+
+
+class ConfigWatcher:
+    """Watches a config file from a background thread.
+
+    A change is read, parsed and validated on that thread, and the resulting
+    Config is handed over whole: the trading loop calls take() between two
+    iterations and either gets the new Config or None. A file that does not
+    validate is reported and the running configuration stays in force.
+    Reports are handed over through take() as well: the Logger only takes
+    records from one thread, the trading loop's."""
+
+    def __init__(self, path, strategies, log, interval=0.5):
+        self.path = path
+        self.strategies = strategies
+        self.log = log
+        self.interval = interval
+        self.stamp = None
+        self.pending = None
+        # (format, args) for the trading thread to log
+        self.notes = deque()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def _stamp(self):
+        stat = os.stat(self.path)
+        return stat.st_mtime_ns, stat.st_size
+
+    def load(self):
+        """Read the file as it is now; errors are raised, for use at startup"""
+        self.stamp = self._stamp()
+        with open(self.path) as f:
+            return compile_config(json.load(f), self.strategies)
+
+    def start(self):
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self._run, name="config", daemon=True)
+        self.thread.start()
+        return self
+
+    def take(self):
+        """The newest valid Config not yet taken, or None"""
+        if self.pending is None and not self.notes:
+            return None
+        notes = self.notes
+        while notes:
+            format, args = notes.popleft()
+            self.log.log("config", format, *args)
+        with self.lock:
+            config, self.pending = self.pending, None
+        return config
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                stamp = self._stamp()
+                if stamp == self.stamp:
+                    continue
+                self.stamp = stamp
+                config = self.load()
+            except OSError as error:
+                if self.stamp is not None:
+                    self.notes.append(("Cannot read %s (%s), keeping the current config", (self.path, error)))
+                    self.stamp = None
+                continue
+            except ValueError as error:
+                self.notes.append(("Ignoring %s: %s", (self.path, error)))
+                continue
+            except Exception as error:
+                # Whatever it was, later edits of the file must still be picked up
+                self.notes.append(("Ignoring %s, failed with %r", (self.path, error)))
+                continue
+            self.notes.append(("Loaded %s", (self.path,)))
+            with self.lock:
+                self.pending = config
+
+    def close(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
@@ -0,0 +1,33 @@
+from protocol import message_types, symbols
+
+ALL_SYMBOLS = None
+
+
+class Dispatcher:
+    """Routes messages to handlers through a table indexed by (type, symbol) codes.
+
+    Types and symbols map to small integers once, at subscribe time. Each
+    table cell holds exactly the handlers that want that pair, so the cost
+    per message is two dict lookups no matter how many handlers exist.
+    Column 0 is for messages without a symbol (ack, out, reject, ...)."""
+
+    def __init__(self):
+        # The last row catches any type the exchange adds later
+        self.type_codes = {t: i for i, t in enumerate(message_types)}
+        self.unknown_type = len(message_types)
+        self.symbol_codes = {s: i + 1 for i, s in enumerate(symbols)}
+        self.table = [[() for _ in range(len(symbols) + 1)] for _ in range(len(message_types) + 1)]
+
+    def subscribe(self, handler, kind, symbol=ALL_SYMBOLS):
+        """Call handler(message) for every [kind] message about [symbol].
+        ALL_SYMBOLS also covers messages that have no symbol."""
+        row = self.table[self.type_codes.get(kind, self.unknown_type)]
+        columns = range(len(row)) if symbol is ALL_SYMBOLS else [self.symbol_codes[symbol]]
+        for column in columns:
+            # Cells are tuples so dispatch() iterates without any copying
+            row[column] = row[column] + (handler,)
+
+    def dispatch(self, message):
+        row = self.table[self.type_codes.get(message["type"], self.unknown_type)]
+        for handler in row[self.symbol_codes.get(message.get("symbol"), 0)]:
+            handler(message)
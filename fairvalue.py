@@ -0,0 +1,54 @@
+class BasketFairValue:
+    """Fair value of an ETF from the mids of its basket, kept up to date per book message.
+
+    The weighted sum of component mids is adjusted by the change in one mid
+    whenever that component's book moves, so fair value and the ETF-vs-basket
+    spread are O(1) to read. [dirty] is set whenever fair value changes and
+    is left for the consumer to clear."""
+
+    def __init__(self, etf, weights, fixed=None):
+        self.etf = etf
+        self.weights = dict(weights)
+        self.divisor = sum(self.weights.values())
+        # Components with a known fair value start from it, e.g. BOND at 1000
+        self.mids = {s: (fixed or {}).get(s) for s in self.weights}
+        self.missing = sum(1 for mid in self.mids.values() if mid is None)
+        self.basket_sum = sum(self.weights[s] * mid for s, mid in self.mids.items() if mid is not None)
+        self.etf_mid = None
+        self.fair = None
+        self.dirty = False
+        self._refresh()
+
+    def on_book(self, symbol, book):
+        mid = book.mid()
+        if symbol == self.etf:
+            self.etf_mid = mid
+            return
+        weight = self.weights.get(symbol)
+        if weight is None:
+            return
+        old = self.mids[symbol]
+        if mid == old:
+            return
+        if old is None:
+            self.missing -= 1
+        else:
+            self.basket_sum -= weight * old
+        if mid is None:
+            self.missing += 1
+        else:
+            self.basket_sum += weight * mid
+        self.mids[symbol] = mid
+        self._refresh()
+
+    def _refresh(self):
+        fair = self.basket_sum // self.divisor if not self.missing else None
+        if fair != self.fair:
+            self.fair = fair
+            self.dirty = True
+
+    def spread(self):
+        """ETF mid minus basket fair value, None until both are known"""
+        if self.fair is None or self.etf_mid is None:
+            return None
+        return self.etf_mid - self.fair
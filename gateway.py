@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+
+# ~~~~~============== LOCAL GATEWAY ==============~~~~~
+# Holds the team's one exchange connection and lets any number of strategy
+# processes share it over a Unix socket.
+#
+#   ./gateway.py --test prod-like --socket /tmp/etc-gateway.sock
+#   ./bot.py --gateway /tmp/etc-gateway.sock
+#
+# Clients speak the exchange protocol in length prefixed frames (see
+# protocol.FRAME). Market data is passed on to every client as the exchange's
+# own bytes, never parsed here. Orders from all clients go through one risk
+# check and one rate limiter, under order ids the gateway hands out; acks,
+# fills, outs and rejects are mapped back to the client's id and only go to
+# the client that owns the order. A client that disconnects has its orders
+# cancelled, the way the exchange treats a team that disconnects.
+
+import argparse
+import os
+import selectors
+import socket
+
+import bot
+from orders import OrderIdJournal
+from protocol import (Decoder, encode_message, frame, interned_dirs, market_data_types,
+    message_symbol, message_type, symbols)
+from ratelimit import PRIORITY_QUOTE
+from risk import RiskEngine
+from transport import Transport
+
+# A client this far behind on market data is dropped rather than buffered forever
+max_client_backlog = 64 << 20
+
+
+class GatewayConnection(bot.ExchangeConnection):
+    """An ExchangeConnection that hands out (type, message, raw line).
+    Market data is left unparsed, [message] is None for it."""
+
+    def _decode_lines(self):
+        decode = self.decoder.decode
+        capture = self.capture
+        recv_ns = self.transport.recv_ns
+        for line in self.transport.records():
+            if capture is not None:
+                capture.inbound(recv_ns, line)
+            kind = message_type(line)
+            if kind in market_data_types:
+                self.messages.append((kind, None, bytes(line)))
+            else:
+                self.messages.append((kind, decode(line), bytes(line)))
+
+
+class Client:
+    def __init__(self, sock):
+        self.transport = Transport(sock, blocking=False, framed=True)
+        self.ready = False
+        # client order id -> gateway order id
+        self.orders = {}
+
+    def send(self, data):
+        """Queue one newline terminated message"""
+        self.transport.send(frame(data))
+
+
+class Gateway:
+    def __init__(self, exchange, path, journal=None):
+        self.exchange = exchange
+        self.path = path
+        self.journal = journal
+        self.last_order_id = journal.first if journal is not None else 0
+        # gateway order id -> [client, client order id, size still open, or None for converts]
+        self.orders = {}
+        self.clients = {}
+        self.decoder = Decoder()
+        self.open = None
+        # Latest book per symbol, so a new client starts with a full picture
+        self.books = {}
+
+        if os.path.exists(path):
+            os.unlink(path)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(path)
+        self.listener.listen()
+        self.listener.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.listener, selectors.EVENT_READ)
+        # The exchange's own selector is pollable, and follows it across reconnects
+        self.selector.register(exchange.selector, selectors.EVENT_READ)
+
+    def next_order_id(self):
+        self.last_order_id += 1
+        if self.journal is not None and self.last_order_id > self.journal.refill_at:
+            self.journal.advance(self.last_order_id)
+        return self.last_order_id
+
+    def serve(self):
+        exchange = self.exchange
+        print("Gateway listening on", self.path)
+        while True:
+            timeout = exchange.limiter.next_release()
+            for key, _ in self.selector.select(1 if timeout is None else timeout):
+                if key.fileobj is self.listener:
+                    self._accept()
+                elif key.fileobj is exchange.selector:
+                    # wait(0) also notices an exchange gone silent and reconnects
+                    exchange.wait(0)
+                    for kind, message, line in exchange.read_available():
+                        if self._on_exchange(kind, message, line):
+                            return
+                else:
+                    self._on_client(key.data)
+            exchange.flush()
+            for client in list(self.clients.values()):
+                client.transport.flush()
+                if len(client.transport.out) > max_client_backlog:
+                    print("Dropping a client that stopped reading")
+                    self._drop(client)
+
+    def close(self):
+        for client in list(self.clients.values()):
+            self._drop(client)
+        self.listener.close()
+        os.unlink(self.path)
+
+    # ~~~~~ exchange -> clients ~~~~~
+
+    def _broadcast(self, data):
+        for client in self.clients.values():
+            if client.ready:
+                client.send(data)
+
+    def _on_exchange(self, kind, message, line):
+        """Returns True once the round is over"""
+        data = line + b"\n"
+        if kind in market_data_types:
+            if kind == "book":
+                self.books[message_symbol(line)] = data
+            self._broadcast(data)
+            return False
+        if kind == "hello":
+            # Only ever after a reconnect: the exchange pulled every order
+            self.exchange.risk.reset({s["symbol"]: s["position"] for s in message["symbols"]})
+            for client in self.clients.values():
+                client.orders.clear()
+            self.orders.clear()
+            self._broadcast(data)
+        elif kind in ("ack", "fill", "out", "reject"):
+            self.exchange.risk.on_message(message)
+            entry = self.orders.get(message["order_id"])
+            if entry is None:
+                return False
+            client, client_order_id, remaining = entry
+            done = kind in ("out", "reject") or (kind == "ack" and remaining is None)
+            if kind == "fill":
+                entry[2] = remaining = remaining - message["size"]
+                done = remaining <= 0
+            if done:
+                del self.orders[message["order_id"]]
+                client.orders.pop(client_order_id, None)
+            message["order_id"] = client_order_id
+            client.send(encode_message(message))
+        elif kind == "open":
+            self.open = data
+            self._broadcast(data)
+        elif kind == "close":
+            self._broadcast(data)
+            for client in self.clients.values():
+                client.transport.flush()
+            return True
+        else:
+            self._broadcast(data)
+        return False
+
+    # ~~~~~ clients -> exchange ~~~~~
+
+    def _accept(self):
+        sock, _ = self.listener.accept()
+        client = Client(sock)
+        self.clients[sock.fileno()] = client
+        self.selector.register(sock, selectors.EVENT_READ, client)
+
+    def _drop(self, client):
+        exchange = self.exchange
+        for order_id in client.orders.values():
+            entry = self.orders.pop(order_id)
+            if entry[2] is not None:
+                exchange.send_cancel_message(order_id)
+        client.orders.clear()
+        self.selector.unregister(client.transport.sock)
+        del self.clients[client.transport.fileno()]
+        client.transport.close()
+
+    def _on_client(self, client):
+        try:
+            if not client.transport.fill():
+                return
+        except OSError:
+            self._drop(client)
+            return
+        decode = self.decoder.decode
+        for line in client.transport.records():
+            try:
+                self._on_request(client, decode(line))
+            except (ValueError, KeyError, TypeError, AttributeError):
+                client.send(encode_message({"type": "error", "error": "MALFORMED_MESSAGE"}))
+
+    def _on_request(self, client, message):
+        kind = message.get("type")
+        exchange = self.exchange
+        if kind == "hello":
+            client.ready = True
+            positions = exchange.risk.symbols
+            client.send(encode_message({
+                "type": "hello",
+                "symbols": [{"symbol": s, "position": positions[s][0]} for s in symbols],
+            }))
+            if self.open is not None:
+                client.send(self.open)
+            for data in self.books.values():
+                client.send(data)
+            return
+        if not client.ready:
+            client.send(encode_message({"type": "error", "error": "HELLO_REQUIRED"}))
+            return
+        client_order_id = message.get("order_id")
+        if kind == "add" or kind == "convert":
+            if client_order_id in client.orders:
+                client.send(encode_message(
+                    {"type": "reject", "order_id": client_order_id, "error": "DUPLICATE_ORDER_ID"}
+                ))
+                return
+            order_id = self.next_order_id()
+            symbol = message.get("symbol")
+            dir = interned_dirs.get(message.get("dir"))
+            if symbol not in exchange.risk.symbols or dir is None:
+                client.send(encode_message(
+                    {"type": "reject", "order_id": client_order_id, "error": "MALFORMED_MESSAGE"}
+                ))
+                return
+            if kind == "add":
+                self.orders[order_id] = [client, client_order_id, message["size"]]
+                sent = exchange.send_add_message(
+                    order_id, symbol, dir, message["price"], message["size"], PRIORITY_QUOTE
+                )
+            else:
+                self.orders[order_id] = [client, client_order_id, None]
+                sent = exchange.send_convert_message(order_id, symbol, dir, message["size"])
+            if sent is False:
+                del self.orders[order_id]
+                client.send(encode_message(
+                    {"type": "reject", "order_id": client_order_id, "error": "LIMIT:POSITION"}
+                ))
+                return
+            client.orders[client_order_id] = order_id
+        elif kind == "cancel":
+            order_id = client.orders.get(client_order_id)
+            if order_id is None:
+                return
+            if exchange.send_cancel_message(order_id) is False:
+                # Never left the rate limiter, so the client hears "out" from us
+                del self.orders[order_id]
+                del client.orders[client_order_id]
+                client.send(encode_message({"type": "out", "order_id": client_order_id}))
+        else:
+            client.send(encode_message({"type": "error", "error": "UNKNOWN_MESSAGE_TYPE"}))
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Share one exchange connection between local strategy processes.")
+    bot.add_exchange_arguments(parser, gateway=False)
+    parser.add_argument("--socket", type=str, default="/tmp/etc-gateway.sock", metavar="PATH",
+                        help="Unix socket the clients connect to.")
+    parser.add_argument(
+        "--journal", type=str, default="gateway_ids.journal", metavar="PATH",
+        help="File keeping the order id high-water mark across restarts; empty to disable.",
+    )
+    parser.add_argument(
+        "--limit", type=bot.parse_limit, action="append", metavar="SYMBOL=SIZE",
+        help="Tighter position limit for the risk check than the exchange's own.",
+    )
+    args = bot.resolve_exchange_address(parser.parse_args())
+    args.limit = dict(args.limit or ())
+    return args
+
+
+def main():
+    args = parse_arguments()
+    exchange = GatewayConnection(
+        args=args, subscribed=symbols, blocking=False, risk=RiskEngine(args.limit), reconnect=True
+    )
+    bot.log.start()
+    _, hello, _ = exchange.read_message()
+    print("First message from exchange:", hello)
+    exchange.risk.reset({s["symbol"]: s["position"] for s in hello["symbols"]})
+    gateway = Gateway(exchange, args.socket, OrderIdJournal(args.journal) if args.journal else None)
+    try:
+        gateway.serve()
+        print("The round has ended")
+    finally:
+        gateway.close()
+        bot.log.close()
+
+
+if __name__ == "__main__":
+    main()
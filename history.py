@@ -0,0 +1,136 @@
+import math
+import time
+
+import numpy as np
+
+TS, BID, ASK, MID, PRICE, SIZE = range(6)
+columns = {"ts": TS, "bid": BID, "ask": ASK, "mid": MID, "price": PRICE, "size": SIZE}
+
+
+class SymbolHistory:
+    """Fixed capacity ring of (ts, bid, ask, mid, trade price, trade size) rows.
+
+    Book updates add a row with the trade columns at 0, trades add a row
+    that carries the last bid/ask forward, so every row is a full snapshot.
+    Each row is written twice, [capacity] apart, which keeps the last n rows
+    one contiguous slice: windows are views, never copies or Python loops.
+    The EWMA of squared log returns of mid is kept up to date per row."""
+
+    def __init__(self, capacity=1 << 16, halflife=100):
+        self.capacity = capacity
+        self.rows = np.zeros((2 * capacity, 6))
+        self.count = 0
+        self.bid = self.ask = self.mid = math.nan
+        self.decay = 0.5 ** (1 / halflife)
+        self.variance = 0.0
+
+    def _append(self, ts, price, size):
+        index = self.count % self.capacity
+        row = (ts, self.bid, self.ask, self.mid, price, size)
+        self.rows[index] = row
+        self.rows[index + self.capacity] = row
+        self.count += 1
+
+    def quote(self, ts, bid, ask):
+        bid = math.nan if bid is None else bid
+        ask = math.nan if ask is None else ask
+        mid = (bid + ask) / 2
+        if mid > 0 and self.mid > 0 and mid != self.mid:
+            r = math.log(mid / self.mid)
+            self.variance = self.decay * self.variance + (1 - self.decay) * r * r
+        self.bid, self.ask = bid, ask
+        if not math.isnan(mid):
+            self.mid = mid
+        self._append(ts, 0.0, 0.0)
+
+    def trade(self, ts, price, size):
+        self._append(ts, price, size)
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def last(self, n=None):
+        """View of the last [n] rows (all of them by default), oldest first"""
+        n = len(self) if n is None else min(n, len(self))
+        end = self.count % self.capacity + self.capacity
+        return self.rows[end - n:end]
+
+    def since(self, ts):
+        """View of the rows at or after [ts]"""
+        rows = self.last()
+        return rows[np.searchsorted(rows[:, TS], ts):]
+
+    def rolling_mean(self, n, column="mid"):
+        values = self.last(n)[:, columns[column]]
+        return float(np.nanmean(values)) if len(values) else math.nan
+
+    def vwap(self, rows=None):
+        """Volume weighted trade price over [rows] (default: everything kept)"""
+        rows = self.last() if rows is None else rows
+        volume = rows[:, SIZE].sum()
+        return float(rows[:, PRICE] @ rows[:, SIZE] / volume) if volume else math.nan
+
+    def volatility(self):
+        """EWMA standard deviation of mid log returns, per update"""
+        return math.sqrt(self.variance)
+
+    def ewma_volatility(self, rows=None, halflife=None):
+        """Same statistic computed in one batch over [rows], e.g. for another halflife"""
+        rows = self.last() if rows is None else rows
+        mids = rows[:, MID]
+        mids = mids[~np.isnan(mids)]
+        returns = np.diff(np.log(mids))
+        returns = returns[returns != 0]
+        if not len(returns):
+            return 0.0
+        decay = self.decay if halflife is None else 0.5 ** (1 / halflife)
+        weights = (1 - decay) * decay ** np.arange(len(returns) - 1, -1, -1)
+        return float(math.sqrt(weights @ (returns * returns)))
+
+    def sample(self, grid, column="mid"):
+        """[column] as of each timestamp in [grid] (NaN before the first row)"""
+        if not len(self):
+            return np.full(np.shape(grid), math.nan)
+        rows = self.last()
+        index = np.searchsorted(rows[:, TS], grid, side="right") - 1
+        values = rows[index, columns[column]]
+        values[index < 0] = math.nan
+        return values
+
+
+class History:
+    """One SymbolHistory per symbol, plus derived series such as a basket fair value"""
+
+    def __init__(self, capacity=1 << 16, halflife=100, clock=time.monotonic):
+        self.capacity = capacity
+        self.halflife = halflife
+        self.clock = clock
+        self.series = {}
+
+    def __getitem__(self, name):
+        series = self.series.get(name)
+        if series is None:
+            series = self.series[name] = SymbolHistory(self.capacity, self.halflife)
+        return series
+
+    def on_book(self, symbol, book):
+        self[symbol].quote(self.clock(), book.bid, book.ask)
+
+    def on_trade(self, message):
+        self[message["symbol"]].trade(self.clock(), message["price"], message["size"])
+
+    def on_value(self, name, value):
+        """Record a derived value, e.g. XLF basket fair value, as a zero width quote"""
+        self[name].quote(self.clock(), value, value)
+
+    def correlation(self, a, b, window=1.0, step=0.001):
+        """Correlation of [a] and [b] mid returns on a [step] grid over the last [window] seconds"""
+        now = self.clock()
+        grid = np.arange(now - window, now, step)
+        returns_a = np.diff(self[a].sample(grid))
+        returns_b = np.diff(self[b].sample(grid))
+        valid = ~(np.isnan(returns_a) | np.isnan(returns_b))
+        returns_a, returns_b = returns_a[valid], returns_b[valid]
+        if len(returns_a) < 2 or not returns_a.std() or not returns_b.std():
+            return math.nan
+        return float(np.corrcoef(returns_a, returns_b)[0, 1])
@@ -0,0 +1,87 @@
+from array import array
+
+# Log-linear buckets: values below 32 ns get their own bucket, above that
+# every power of two is split into 16 equal buckets (about 6% precision).
+SUB_BITS = 4
+SUB_BUCKETS = 1 << SUB_BITS
+MAX_SHIFT = 40
+BUCKETS = (MAX_SHIFT + 2) * SUB_BUCKETS
+
+
+def bucket_index(value):
+    shift = value.bit_length() - SUB_BITS - 1
+    if shift <= 0:
+        return value
+    if shift > MAX_SHIFT:
+        return BUCKETS - 1
+    return shift * SUB_BUCKETS + (value >> shift)
+
+
+def bucket_value(index):
+    """Lowest value that lands in bucket [index]"""
+    if index < 2 * SUB_BUCKETS:
+        return index
+    shift = index // SUB_BUCKETS - 1
+    return (index - shift * SUB_BUCKETS) << shift
+
+
+class Histogram:
+    """Fixed memory latency histogram in nanoseconds"""
+
+    __slots__ = ("counts", "count", "max")
+
+    def __init__(self):
+        self.counts = array("q", bytes(8 * BUCKETS))
+        self.count = 0
+        self.max = 0
+
+    def record(self, value):
+        if value < 0:
+            value = 0
+        self.counts[bucket_index(value)] += 1
+        self.count += 1
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        if not self.count:
+            return 0
+        target = self.count * p / 100
+        seen = 0
+        for index, n in enumerate(self.counts):
+            seen += n
+            if n and seen >= target:
+                return min(bucket_value(index), self.max)
+        return self.max
+
+
+class LatencyTracker:
+    """Histograms per pipeline stage, and per message type or strategy within a stage"""
+
+    def __init__(self):
+        # stage -> key -> Histogram
+        self.stages = {}
+
+    def stage(self, name):
+        """The key -> Histogram dict for a stage, for hot loops to hold on to"""
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = self.stages[name] = {}
+        return stage
+
+    def record(self, stage, key, value):
+        histograms = self.stage(stage)
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = Histogram()
+        histogram.record(value)
+
+    def report(self):
+        print("%-16s %-12s %9s %10s %10s %10s %10s" % ("stage", "key", "count", "p50 us", "p99 us", "p99.9 us", "max us"))
+        for stage, histograms in self.stages.items():
+            for key, h in sorted(histograms.items()):
+                print(
+                    "%-16s %-12s %9d %10.1f %10.1f %10.1f %10.1f"
+                    % (stage, key, h.count, h.percentile(50) / 1000, h.percentile(99) / 1000,
+                       h.percentile(99.9) / 1000, h.max / 1000)
+                )
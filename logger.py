@@ -0,0 +1,99 @@
+import sys
+import threading
+import time
+
+
+class Logger:
+    """Keeps print() off the trading thread.
+
+    log() only stores (time, category, format, args) in a preallocated ring;
+    a background thread does the % formatting and the writes. The ring never
+    blocks the caller: when it is full, or a category is over its rate limit,
+    the record is dropped and counted. Nothing is recorded until start().
+    The ring has a single producer: log() is for one thread only."""
+
+    def __init__(self, capacity=1 << 14, interval=0.05, stream=None):
+        self.capacity = capacity
+        self.interval = interval
+        # None means whatever sys.stdout is when the thread writes
+        self.stream = stream
+        self.slots = [None] * capacity
+        self.head = 0
+        self.tail = 0
+        self.enabled = False
+        # category -> [records per second, window start, records in window, suppressed]
+        self.limits = {}
+        self.dropped = 0
+        self.stopped = threading.Event()
+        self.writer = None
+
+    def limit(self, category, per_second):
+        """Let at most [per_second] records of [category] through each second"""
+        self.limits[category] = [per_second, 0.0, 0, 0]
+
+    def start(self):
+        """Start the writer thread, again in a forked child if need be"""
+        self.head = self.tail = 0
+        self.stopped.clear()
+        self.writer = threading.Thread(target=self._run, name="logger", daemon=True)
+        self.writer.start()
+        self.enabled = True
+        return self
+
+    def log(self, category, format, *args):
+        if not self.enabled:
+            return
+        now = time.monotonic()
+        limit = self.limits.get(category)
+        if limit is not None:
+            if now - limit[1] >= 1:
+                if limit[3]:
+                    self._put(now, category, "(%d more suppressed)", (limit[3],))
+                limit[1], limit[2], limit[3] = now, 0, 0
+            if limit[2] >= limit[0]:
+                limit[3] += 1
+                return
+            limit[2] += 1
+        self._put(now, category, format, args)
+
+    def _put(self, now, category, format, args):
+        head = self.head
+        if head - self.tail >= self.capacity:
+            self.dropped += 1
+            return
+        self.slots[head % self.capacity] = (now, category, format, args)
+        # Publish only once the slot is filled in
+        self.head = head + 1
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self._drain()
+        self._drain()
+
+    def _drain(self):
+        head, tail = self.head, self.tail
+        if head == tail:
+            return
+        lines = []
+        for i in range(tail, head):
+            index = i % self.capacity
+            now, category, format, args = self.slots[index]
+            self.slots[index] = None
+            try:
+                text = format % args if args else format
+            except (TypeError, ValueError) as e:
+                text = "%r %r (%s)" % (format, args, e)
+            lines.append("%.6f %-10s %s\n" % (now, category, text))
+        self.tail = head
+        stream = self.stream or sys.stdout
+        stream.write("".join(lines))
+        stream.flush()
+
+    def close(self):
+        """Write out whatever is left and stop the thread"""
+        self.enabled = False
+        if self.writer is not None and self.writer.is_alive():
+            self.stopped.set()
+            self.writer.join()
+        if self.dropped:
+            (self.stream or sys.stdout).write("logger: %d records dropped\n" % self.dropped)
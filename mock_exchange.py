@@ -0,0 +1,558 @@
+#!/usr/bin/env python3
+
+# ~~~~~==============   MOCK EXCHANGE   ==============~~~~~
+# A local stand-in for the ETC exchange so the bot can be load tested offline.
+# It speaks the same newline-delimited JSON protocol as the real venue.
+#
+# 1) Start it:   ./mock_exchange.py --port 25000 --rate 20000 --duration 300
+# 2) Point the bot at it:   ./bot.py --specific-address localhost:25000
+#
+# Background "market makers" post, cancel and take liquidity around a random
+# walk fair value for every symbol, so the bot sees a steady stream of book
+# and trade messages at roughly --rate messages per second.
+
+import argparse
+from bisect import bisect_left, insort
+from collections import deque
+import json
+import random
+import selectors
+import socket
+import time
+
+symbols = ['BOND', 'VALBZ', 'VALE', 'GS', 'MS', 'WFC', 'XLF']
+position_limits = {'BOND': 100, 'VALBZ': 10, 'VALE': 10, 'GS': 100, 'MS': 100, 'WFC': 100, 'XLF': 100}
+start_prices = {'BOND': 1000, 'VALBZ': 4000, 'VALE': 4000, 'GS': 8000, 'MS': 4000, 'WFC': 4500}
+
+# A convert of 10 XLF is made up of these amounts of the underlying symbols.
+xlf_basket = {'BOND': 3, 'GS': 2, 'MS': 3, 'WFC': 2}
+adr_convert_fee = 10
+etf_convert_fee = 100
+
+
+class Order:
+    __slots__ = ("order_id", "owner", "symbol", "dir", "price", "size")
+
+    def __init__(self, order_id, owner, symbol, dir, price, size):
+        self.order_id = order_id
+        self.owner = owner
+        self.symbol = symbol
+        self.dir = dir
+        self.price = price
+        self.size = size
+
+
+class MatchingBook:
+    """Price-time priority limit order book for a single symbol"""
+
+    def __init__(self, symbol):
+        self.symbol = symbol
+        # price -> deque of resting orders, oldest first
+        self.levels = {"BUY": {}, "SELL": {}}
+        # price -> total resting size at that price
+        self.level_size = {"BUY": {}, "SELL": {}}
+        # sorted ascending, so the best bid is [-1] and the best ask is [0]
+        self.prices = {"BUY": [], "SELL": []}
+
+    def best(self, dir):
+        prices = self.prices[dir]
+        if not prices:
+            return None
+        return prices[-1] if dir == "BUY" else prices[0]
+
+    def match(self, order, on_fill):
+        """Cross an incoming order against the opposite side.
+        Calls on_fill(resting, incoming, price, size) for every execution."""
+        opposite = "SELL" if order.dir == "BUY" else "BUY"
+        levels = self.levels[opposite]
+        level_size = self.level_size[opposite]
+        prices = self.prices[opposite]
+        while order.size > 0 and prices:
+            price = prices[0] if opposite == "SELL" else prices[-1]
+            if (order.dir == "BUY" and price > order.price) or (
+                order.dir == "SELL" and price < order.price
+            ):
+                break
+            queue = levels[price]
+            while order.size > 0 and queue:
+                resting = queue[0]
+                size = min(order.size, resting.size)
+                resting.size -= size
+                order.size -= size
+                level_size[price] -= size
+                if resting.size == 0:
+                    queue.popleft()
+                on_fill(resting, order, price, size)
+            if not queue:
+                del levels[price]
+                del level_size[price]
+                prices.pop(0 if opposite == "SELL" else -1)
+
+    def rest(self, order):
+        levels = self.levels[order.dir]
+        if order.price not in levels:
+            levels[order.price] = deque()
+            self.level_size[order.dir][order.price] = 0
+            insort(self.prices[order.dir], order.price)
+        levels[order.price].append(order)
+        self.level_size[order.dir][order.price] += order.size
+
+    def remove(self, order):
+        queue = self.levels[order.dir].get(order.price)
+        if queue is None or order not in queue:
+            return False
+        queue.remove(order)
+        self.level_size[order.dir][order.price] -= order.size
+        if not queue:
+            del self.levels[order.dir][order.price]
+            del self.level_size[order.dir][order.price]
+            prices = self.prices[order.dir]
+            del prices[bisect_left(prices, order.price)]
+        return True
+
+    def book_message(self, depth):
+        bids = self.prices["BUY"][-depth:]
+        asks = self.prices["SELL"][:depth]
+        buy_size = self.level_size["BUY"]
+        sell_size = self.level_size["SELL"]
+        return {
+            "type": "book",
+            "symbol": self.symbol,
+            "buy": [[p, buy_size[p]] for p in reversed(bids)],
+            "sell": [[p, sell_size[p]] for p in asks],
+        }
+
+
+class RateLimiter:
+    """Mirrors the real exchange: at most [limit] messages in any one second window"""
+
+    def __init__(self, limit):
+        self.timestamps = deque(maxlen=limit)
+
+    def allow(self, now):
+        timestamps = self.timestamps
+        if len(timestamps) == timestamps.maxlen and timestamps[0] > now - 1:
+            return False
+        timestamps.append(now)
+        return True
+
+
+class Team:
+    def __init__(self, name):
+        self.name = name
+        self.positions = {s: 0 for s in symbols}
+        # Fills and convert fees, so the round can be marked to market at the end
+        self.cash = 0
+        self.used_order_ids = set()
+        self.live_orders = {}
+        self.client = None
+
+
+class Client:
+    def __init__(self, sock, address, rate_limit):
+        self.sock = sock
+        self.address = address
+        self.inbuf = bytearray()
+        self.outbuf = bytearray()
+        self.team = None
+        self.limiter = RateLimiter(rate_limit)
+        self.closed = False
+
+    def send(self, message):
+        self.outbuf += json.dumps(message).encode()
+        self.outbuf += b"\n"
+
+
+class MockExchange:
+    def __init__(self, args):
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.books = {s: MatchingBook(s) for s in symbols}
+        self.fair = dict(start_prices)
+        self.fair["XLF"] = self._xlf_fair()
+        self.teams = {}
+        self.clients = set()
+        self.selector = selectors.DefaultSelector()
+        self.background_orders = {s: deque() for s in symbols}
+        self.background_id = 0
+        self.open = False
+
+    # ~~~~~ networking ~~~~~
+
+    def serve(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((self.args.host, self.args.port))
+        listener.listen()
+        listener.setblocking(False)
+        self.selector.register(listener, selectors.EVENT_READ, None)
+        print("Mock exchange listening on %s:%d" % (self.args.host, self.args.port))
+
+        tick = 0.001
+        start = time.monotonic()
+        last = start
+        pending_events = 0.0
+        self._seed_books()
+        self.open = True
+        try:
+            while True:
+                for key, _ in self.selector.select(timeout=tick):
+                    if key.data is None:
+                        self._accept(listener)
+                    else:
+                        self._on_readable(key.data)
+
+                now = time.monotonic()
+                if self.args.duration and now - start > self.args.duration:
+                    break
+                pending_events += (now - last) * self.args.rate
+                last = now
+                while pending_events >= 1:
+                    self._background_event()
+                    pending_events -= 1
+                self._flush_all()
+        finally:
+            self._close_round()
+            self.selector.close()
+            listener.close()
+
+    def _accept(self, listener):
+        sock, address = listener.accept()
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        client = Client(sock, address, self.args.rate_limit)
+        self.clients.add(client)
+        self.selector.register(sock, selectors.EVENT_READ, client)
+
+    def _on_readable(self, client):
+        try:
+            data = client.sock.recv(65536)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b""
+        if not data:
+            self._drop(client)
+            return
+        client.inbuf += data
+        start = 0
+        while True:
+            end = client.inbuf.find(b"\n", start)
+            if end < 0:
+                break
+            line = bytes(client.inbuf[start:end])
+            start = end + 1
+            if line.strip():
+                self._on_message(client, line)
+            if client.closed:
+                return
+        del client.inbuf[:start]
+
+    def _flush(self, client):
+        if not client.outbuf or client.closed:
+            return
+        try:
+            sent = client.sock.send(client.outbuf)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            self._drop(client)
+            return
+        del client.outbuf[:sent]
+        if len(client.outbuf) > self.args.max_backlog:
+            # A consumer this far behind would be disconnected by the real exchange too
+            print("Disconnecting slow client", client.address)
+            self._drop(client)
+
+    def _flush_all(self):
+        for client in list(self.clients):
+            self._flush(client)
+
+    def _drop(self, client):
+        if client.closed:
+            return
+        client.closed = True
+        self.clients.discard(client)
+        try:
+            self.selector.unregister(client.sock)
+        except (KeyError, ValueError):
+            pass
+        client.sock.close()
+        if client.team is not None and client.team.client is client:
+            # Resting orders are pulled when a team disconnects
+            for order in list(client.team.live_orders.values()):
+                self.books[order.symbol].remove(order)
+            client.team.live_orders.clear()
+            client.team.client = None
+
+    def _broadcast(self, message):
+        line = json.dumps(message).encode() + b"\n"
+        for client in self.clients:
+            if client.team is not None:
+                client.outbuf += line
+
+    def _close_round(self):
+        self._broadcast({"type": "close", "symbols": symbols})
+        for client in list(self.clients):
+            client.sock.settimeout(1)
+            try:
+                client.sock.sendall(client.outbuf)
+                # Let the client read "close" before the socket goes away,
+                # closing with its orders still unread would reset the connection
+                client.sock.shutdown(socket.SHUT_WR)
+                while client.sock.recv(65536):
+                    pass
+            except OSError:
+                pass
+            client.outbuf.clear()
+            self._drop(client)
+        for team in self.teams.values():
+            pnl = team.cash + sum(team.positions[s] * self.fair[s] for s in symbols)
+            print("%s: cash %d, pnl at fair value %d, positions %s" % (team.name, team.cash, pnl, team.positions))
+
+    # ~~~~~ client messages ~~~~~
+
+    def _on_message(self, client, line):
+        now = time.monotonic()
+        try:
+            message = json.loads(line)
+            kind = message["type"]
+        except (ValueError, KeyError, TypeError):
+            client.send({"type": "error", "error": "MALFORMED_MESSAGE"})
+            return
+
+        if client.team is None:
+            if kind != "hello" or not isinstance(message.get("team"), str):
+                client.send({"type": "error", "error": "HELLO_REQUIRED"})
+                return
+            self._on_hello(client, message["team"].upper())
+            return
+
+        if not client.limiter.allow(now):
+            # The real exchange ignores anything over the limit
+            client.send({"type": "error", "error": "RATE_LIMITED"})
+            return
+
+        if kind == "add":
+            self._on_add(client, message)
+        elif kind == "cancel":
+            self._on_cancel(client, message)
+        elif kind == "convert":
+            self._on_convert(client, message)
+        else:
+            client.send({"type": "error", "error": "UNKNOWN_MESSAGE_TYPE"})
+
+    def _on_hello(self, client, name):
+        team = self.teams.get(name)
+        if team is None:
+            team = self.teams[name] = Team(name)
+        if team.client is not None:
+            # Only one connection per team, the newest one wins
+            self._drop(team.client)
+        team.client = client
+        client.team = team
+        client.send(
+            {
+                "type": "hello",
+                "symbols": [{"symbol": s, "position": team.positions[s]} for s in symbols],
+            }
+        )
+        if self.open:
+            client.send({"type": "open", "symbols": symbols})
+            for book in self.books.values():
+                client.send(book.book_message(self.args.depth))
+
+    def _validate_order(self, client, message, need_price):
+        order_id = message.get("order_id")
+        symbol = message.get("symbol")
+        dir = message.get("dir")
+        size = message.get("size")
+        error = None
+        if not isinstance(order_id, int) or order_id < 0:
+            error = "MALFORMED_MESSAGE"
+        elif order_id in client.team.used_order_ids:
+            error = "DUPLICATE_ORDER_ID"
+        elif symbol not in self.books:
+            error = "UNKNOWN_SYMBOL"
+        elif dir not in ("BUY", "SELL"):
+            error = "MALFORMED_MESSAGE"
+        elif not isinstance(size, int) or size <= 0:
+            error = "INVALID_SIZE"
+        elif need_price and (not isinstance(message.get("price"), int) or message["price"] <= 0):
+            error = "INVALID_PRICE"
+        if error is not None:
+            client.send({"type": "reject", "order_id": order_id, "error": error})
+            return False
+        client.team.used_order_ids.add(order_id)
+        return True
+
+    def _on_add(self, client, message):
+        if not self._validate_order(client, message, need_price=True):
+            return
+        team = client.team
+        symbol = message["symbol"]
+        dir = message["dir"]
+        size = message["size"]
+
+        # Worst case position if every open order on this side were filled
+        exposure = team.positions[symbol]
+        for order in team.live_orders.values():
+            if order.symbol == symbol and order.dir == dir:
+                exposure += order.size if dir == "BUY" else -order.size
+        exposure += size if dir == "BUY" else -size
+        if abs(exposure) > position_limits[symbol]:
+            client.send({"type": "reject", "order_id": message["order_id"], "error": "LIMIT:POSITION"})
+            return
+
+        order = Order(message["order_id"], team, symbol, dir, message["price"], size)
+        client.send({"type": "ack", "order_id": order.order_id})
+        self._submit(order)
+
+    def _on_cancel(self, client, message):
+        order = client.team.live_orders.pop(message.get("order_id"), None)
+        if order is None:
+            return
+        self.books[order.symbol].remove(order)
+        client.send({"type": "out", "order_id": order.order_id})
+        self._broadcast(self.books[order.symbol].book_message(self.args.depth))
+
+    def _on_convert(self, client, message):
+        if not self._validate_order(client, message, need_price=False):
+            return
+        team = client.team
+        symbol = message["symbol"]
+        sign = 1 if message["dir"] == "BUY" else -1
+        size = message["size"]
+
+        if symbol in ("VALE", "VALBZ"):
+            other = "VALBZ" if symbol == "VALE" else "VALE"
+            changes = {symbol: sign * size, other: -sign * size}
+        elif symbol == "XLF":
+            if size % 10:
+                client.send({"type": "reject", "order_id": message["order_id"], "error": "INVALID_SIZE"})
+                return
+            changes = {"XLF": sign * size}
+            for s, weight in xlf_basket.items():
+                changes[s] = -sign * weight * size // 10
+        else:
+            client.send({"type": "reject", "order_id": message["order_id"], "error": "UNKNOWN_SYMBOL"})
+            return
+
+        for s, change in changes.items():
+            if abs(team.positions[s] + change) > position_limits[s]:
+                client.send({"type": "reject", "order_id": message["order_id"], "error": "LIMIT:POSITION"})
+                return
+        for s, change in changes.items():
+            team.positions[s] += change
+        # Charged per convert, whatever its size
+        team.cash -= etf_convert_fee if symbol == "XLF" else adr_convert_fee
+        client.send({"type": "ack", "order_id": message["order_id"]})
+
+    # ~~~~~ matching ~~~~~
+
+    def _submit(self, order):
+        book = self.books[order.symbol]
+        book.match(order, self._on_fill)
+        if order.size > 0:
+            book.rest(order)
+            if order.owner is not None:
+                order.owner.live_orders[order.order_id] = order
+            else:
+                self.background_orders[order.symbol].append(order)
+        elif order.owner is not None and order.owner.client is not None:
+            order.owner.client.send({"type": "out", "order_id": order.order_id})
+        self._broadcast(book.book_message(self.args.depth))
+
+    def _on_fill(self, resting, incoming, price, size):
+        self._broadcast({"type": "trade", "symbol": resting.symbol, "price": price, "size": size})
+        for order in (resting, incoming):
+            team = order.owner
+            if team is None:
+                continue
+            team.positions[order.symbol] += size if order.dir == "BUY" else -size
+            team.cash += -price * size if order.dir == "BUY" else price * size
+            if team.client is not None:
+                team.client.send(
+                    {
+                        "type": "fill",
+                        "order_id": order.order_id,
+                        "symbol": order.symbol,
+                        "dir": order.dir,
+                        "price": price,
+                        "size": size,
+                    }
+                )
+            if order is resting and order.size == 0:
+                team.live_orders.pop(order.order_id, None)
+                if team.client is not None:
+                    team.client.send({"type": "out", "order_id": order.order_id})
+
+    # ~~~~~ background flow ~~~~~
+
+    def _xlf_fair(self):
+        return sum(self.fair[s] * w for s, w in xlf_basket.items()) // 10
+
+    def _seed_books(self):
+        for symbol in symbols:
+            for _ in range(self.args.depth):
+                self._background_add(symbol, aggressive=False)
+
+    def _background_add(self, symbol, aggressive):
+        rnd = self.random
+        dir = "BUY" if rnd.random() < 0.5 else "SELL"
+        sign = -1 if dir == "BUY" else 1
+        if aggressive:
+            price = self.fair[symbol] - sign * self.args.spread
+        else:
+            price = self.fair[symbol] + sign * rnd.randint(1, self.args.spread + 5)
+        self.background_id -= 1
+        order = Order(self.background_id, None, symbol, dir, max(price, 1), rnd.randint(1, 10))
+        self._submit(order)
+
+    def _background_event(self):
+        rnd = self.random
+        symbol = rnd.choice(symbols)
+        if symbol != "BOND" and rnd.random() < 0.05:
+            if symbol == "VALBZ" or symbol == "VALE":
+                self.fair["VALBZ"] += rnd.choice((-1, 1))
+                self.fair["VALE"] = self.fair["VALBZ"]
+            elif symbol != "XLF":
+                self.fair[symbol] += rnd.choice((-1, 1))
+            self.fair["XLF"] = self._xlf_fair()
+
+        resting = self.background_orders[symbol]
+        # Orders that have already been filled are dropped lazily
+        while resting and resting[0].size == 0:
+            resting.popleft()
+        roll = rnd.random()
+        if roll < 0.3 and resting or len(resting) > self.args.max_resting:
+            order = resting.popleft()
+            if self.books[symbol].remove(order):
+                self._broadcast(self.books[symbol].book_message(self.args.depth))
+        else:
+            self._background_add(symbol, aggressive=roll > 0.9)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Run a local mock ETC exchange.")
+    parser.add_argument("--host", type=str, default="localhost")
+    parser.add_argument("--port", type=int, default=25000)
+    parser.add_argument(
+        "--rate", type=float, default=1000,
+        help="Background order events per second (each produces at least one book message).",
+    )
+    parser.add_argument(
+        "--rate-limit", type=int, default=500,
+        help="Messages a client may send in any one second window.",
+    )
+    parser.add_argument("--duration", type=float, default=300, help="Round length in seconds, 0 runs forever.")
+    parser.add_argument("--depth", type=int, default=10, help="Price levels per side in book messages.")
+    parser.add_argument("--spread", type=int, default=2, help="Background half spread around fair value.")
+    parser.add_argument("--max-resting", type=int, default=200, help="Background resting orders per symbol.")
+    parser.add_argument("--max-backlog", type=int, default=64 << 20, help="Outbound bytes before a client is dropped.")
+    parser.add_argument("--seed", type=int, default=None)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    MockExchange(parse_arguments()).serve()
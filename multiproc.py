@@ -0,0 +1,346 @@
+# ~~~~~============== MULTI-PROCESS MODE ==============~~~~~
+# ./bot.py --test prod-like --workers XLF_trade,XLF_balance --workers ADR_trade,ADR_balance
+#
+# The main process becomes the feed handler: it owns the read side of the
+# exchange connection and publishes books and positions into shared memory
+# under a seqlock. Each --workers group runs in its own process with its own
+# scheduler, reads that shared state and pushes order intents through a
+# single-producer/single-consumer ring buffer. One order gateway process owns
+# the write side of the connection, turns intents into orders through the
+# OrderManager, and learns about acks and fills from a ring fed by the feed
+# handler. When a quote's order is done (filled, rejected or gone) the gateway
+# bumps that quote's counter in shared memory and the worker decides again.
+# A slow strategy therefore never delays reading market data.
+
+import multiprocessing
+from multiprocessing import shared_memory
+import struct
+import time
+
+from orders import finished_states
+from protocol import Dir, symbols
+
+DEPTH = 10
+# seq, buy levels, sell levels, then DEPTH (price, size) pairs per side
+BOOK_STRIDE = 3 + 4 * DEPTH
+POSITIONS = len(symbols) * BOOK_STRIDE
+DONE = POSITIONS + 1 + len(symbols)
+# Quotes a worker can keep apart, its slot numbers fit in one byte
+SLOTS = 256
+
+symbol_codes = {s: i for i, s in enumerate(symbols)}
+dir_codes = {Dir.BUY: 0, Dir.SELL: 1}
+dirs = [Dir.BUY, Dir.SELL]
+
+# Order intent from a strategy worker: symbol, dir, priority, quote slot, quote name, price, size
+INTENT = struct.Struct("<BBBB16sii")
+# Order event for the gateway: kind, symbol, dir, order_id, price, size
+EVENT = struct.Struct("<BBBxqii")
+event_kinds = ["ack", "fill", "out", "reject", "close"]
+event_codes = {k: i for i, k in enumerate(event_kinds)}
+
+idle_sleep = 0.0002
+
+
+class SharedBooks:
+    """Top DEPTH levels of every book plus positions in one shared memory block.
+
+    Each book and the positions block carry a sequence number that is odd
+    while the feed handler is writing, so readers retry until they copy a
+    consistent snapshot (a seqlock). Only the feed handler writes those.
+
+    After them come SLOTS done counters per worker, one per quote, which
+    only the gateway writes: it bumps one each time an order standing for
+    that quote is finished."""
+
+    def __init__(self, workers=0):
+        words = DONE + workers * SLOTS
+        self.shm = shared_memory.SharedMemory(create=True, size=8 * words)
+        self.words = self.shm.buf.cast("q")
+        for i in range(words):
+            self.words[i] = 0
+
+    def publish_book(self, symbol, buy, sell):
+        words = self.words
+        base = symbol_codes[symbol] * BOOK_STRIDE
+        seq = words[base] + 1
+        words[base] = seq
+        buy = buy[:DEPTH]
+        sell = sell[:DEPTH]
+        words[base + 1] = len(buy)
+        words[base + 2] = len(sell)
+        offset = base + 3
+        for price, size in buy:
+            words[offset] = price
+            words[offset + 1] = size
+            offset += 2
+        offset = base + 3 + 2 * DEPTH
+        for price, size in sell:
+            words[offset] = price
+            words[offset + 1] = size
+            offset += 2
+        words[base] = seq + 1
+
+    def book_seq(self, symbol):
+        return self.words[symbol_codes[symbol] * BOOK_STRIDE]
+
+    def read_book(self, symbol):
+        """Returns (seq, buy, sell) from a consistent snapshot"""
+        words = self.words
+        base = symbol_codes[symbol] * BOOK_STRIDE
+        while True:
+            seq = words[base]
+            if seq & 1:
+                continue
+            levels = words[base + 1:base + BOOK_STRIDE].tolist()
+            if words[base] == seq:
+                break
+        buy_n, sell_n = levels[0], levels[1]
+        buy = [[levels[2 + 2 * i], levels[3 + 2 * i]] for i in range(buy_n)]
+        sell = [[levels[2 + 2 * DEPTH + 2 * i], levels[3 + 2 * DEPTH + 2 * i]] for i in range(sell_n)]
+        return seq, buy, sell
+
+    def publish_positions(self, positions):
+        words = self.words
+        seq = words[POSITIONS] + 1
+        words[POSITIONS] = seq
+        for symbol, position in positions.items():
+            words[POSITIONS + 1 + symbol_codes[symbol]] = position
+        words[POSITIONS] = seq + 1
+
+    def read_positions(self, into):
+        words = self.words
+        while True:
+            seq = words[POSITIONS]
+            if seq & 1:
+                continue
+            values = words[POSITIONS + 1:POSITIONS + 1 + len(symbols)].tolist()
+            if words[POSITIONS] == seq:
+                break
+        for symbol, position in zip(symbols, values):
+            into[symbol] = position
+
+    def finish(self, worker, slot):
+        self.words[DONE + worker * SLOTS + slot] += 1
+
+    def done(self, worker, slot):
+        return self.words[DONE + worker * SLOTS + slot]
+
+    def close(self, unlink=False):
+        self.words.release()
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+class RingBuffer:
+    """Single-producer/single-consumer ring of fixed size records in shared memory.
+
+    The producer only ever writes [head] and the consumer only [tail], each
+    on its own cache line, so no lock is needed."""
+
+    def __init__(self, record, capacity=4096):
+        self.record = record
+        self.capacity = capacity
+        self.shm = shared_memory.SharedMemory(create=True, size=128 + record.size * capacity)
+        self.counters = self.shm.buf[:128].cast("q")
+        # head at word 0, tail at word 8
+        self.counters[0] = 0
+        self.counters[8] = 0
+        self.slots = self.shm.buf[128:]
+
+    def push(self, *values):
+        """Returns False when the ring is full"""
+        head = self.counters[0]
+        if head - self.counters[8] >= self.capacity:
+            return False
+        self.record.pack_into(self.slots, (head % self.capacity) * self.record.size, *values)
+        self.counters[0] = head + 1
+        return True
+
+    def pop(self):
+        """Returns the oldest record, or None when the ring is empty"""
+        tail = self.counters[8]
+        if tail == self.counters[0]:
+            return None
+        values = self.record.unpack_from(self.slots, (tail % self.capacity) * self.record.size)
+        self.counters[8] = tail + 1
+        return values
+
+    def close(self, unlink=False):
+        self.counters.release()
+        self.slots.release()
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+class IntentQueue:
+    """Takes the OrderManager's place inside a strategy worker.
+
+    quote() only pushes an intent when the wanted price or size changes.
+    Once the gateway reports the quote's order done, refresh() forgets what
+    was sent, so the strategy's next quote() goes out again even at the
+    same price and size."""
+
+    def __init__(self, ring, shared, worker):
+        self.ring = ring
+        self.shared = shared
+        self.worker = worker
+        # (name, symbol, dir) -> (price, size) last sent
+        self.standing = {}
+        # (name, symbol, dir) -> slot, and each slot's done count as last seen
+        self.slots = {}
+        self.seen = []
+
+    def refresh(self):
+        """Drop the quotes whose order the gateway has finished since the last call"""
+        shared, worker, seen = self.shared, self.worker, self.seen
+        for key, slot in self.slots.items():
+            done = shared.done(worker, slot)
+            if done != seen[slot]:
+                seen[slot] = done
+                self.standing.pop(key, None)
+
+    def quote(self, exchange, name, symbol, dir, price, size, priority=2):
+        key = (name, symbol, dir)
+        if price is None or size <= 0:
+            price, size = -1, 0
+        if self.standing.get(key) == (price, size):
+            return
+        slot = self.slots.get(key)
+        if slot is None:
+            slot = self.slots[key] = len(self.seen)
+            if slot >= SLOTS:
+                raise ValueError("More than %d quotes in one worker" % SLOTS)
+            self.seen.append(self.shared.done(self.worker, slot))
+        while not self.ring.push(symbol_codes[symbol], dir_codes[dir], priority, slot, name.encode(), price, size):
+            # The gateway is behind, give it a moment rather than lose a cancel
+            time.sleep(idle_sleep)
+        self.standing[key] = (price, size)
+
+    def quoting(self, name, symbol, dir):
+        wanted = self.standing.get((name, symbol, dir))
+        return wanted is not None and wanted[1] > 0
+
+
+def strategy_worker(bot, shared, worker, ring, names, params):
+    bot.reset_state()
+    # The logger's thread did not come across the fork
+    bot.log.start()
+    intents = bot.order_manager = IntentQueue(ring, shared, worker)
+    scheduler = bot.Scheduler()
+    if not bot.schedule_strategies(scheduler, None, params, only=names):
+        print("Worker for %s has no enabled strategy, exiting" % ",".join(names))
+        return
+    seen = {s: 0 for s in symbols}
+    while True:
+        timeout = scheduler.next_deadline() - time.monotonic()
+        if timeout > 0:
+            time.sleep(timeout)
+        # Only copy the books that changed since the last run
+        for symbol in symbols:
+            if shared.book_seq(symbol) != seen[symbol]:
+                seen[symbol], buy, sell = shared.read_book(symbol)
+                bot.bookdata_update({"type": "book", "symbol": symbol, "buy": buy, "sell": sell})
+        shared.read_positions(bot.positions)
+        intents.refresh()
+        scheduler.run_due()
+
+
+def order_gateway(bot, shared, exchange, events, rings):
+    # The capture writer's thread stayed behind in the feed handler
+    exchange.capture = None
+    # Ids carry on from the journal, the round may already have used the low ones
+    manager = bot.OrderManager(journal=bot.order_manager.journal)
+    # (name, symbol, dir) -> (order, worker, slot) for every quote with an order out
+    live = {}
+    while True:
+        busy = False
+        event = events.pop()
+        while event is not None:
+            busy = True
+            kind, symbol, dir, order_id, price, size = event
+            kind = event_kinds[kind]
+            if kind == "close":
+                exchange.flush()
+                return
+            message = {"type": kind, "order_id": order_id, "symbol": symbols[symbol], "dir": dirs[dir],
+                       "price": price, "size": size}
+            if exchange.risk is not None:
+                exchange.risk.on_message(message)
+            manager.on_message(message)
+            event = events.pop()
+        # Only the newest intent per quote matters
+        wanted = {}
+        for worker, ring in enumerate(rings):
+            intent = ring.pop()
+            while intent is not None:
+                busy = True
+                symbol, dir, priority, slot, name, price, size = intent
+                wanted[(name.rstrip(b"\0").decode(), symbols[symbol], dirs[dir])] = (
+                    None if price < 0 else price, size, priority, worker, slot,
+                )
+                intent = ring.pop()
+        for key, (price, size, priority, worker, slot) in wanted.items():
+            order = manager.quote(exchange, *key, price, size, priority)
+            if order is None:
+                live.pop(key, None)
+            else:
+                live[key] = (order, worker, slot)
+        if busy:
+            # Hand quotes whose order is done back to their worker to decide again
+            for key in [key for key, (order, _, _) in live.items() if order.state in finished_states]:
+                _, worker, slot = live.pop(key)
+                shared.finish(worker, slot)
+        exchange.flush()
+        if not busy:
+            time.sleep(idle_sleep)
+
+
+def run(bot, exchange, groups, params=None):
+    """Feed handler loop, after starting the gateway and one worker per group"""
+    context = multiprocessing.get_context("fork")
+    shared = SharedBooks(len(groups))
+    # Positions from the hello, in place before any worker looks
+    positions = dict(bot.positions)
+    shared.publish_positions(positions)
+    events = RingBuffer(EVENT)
+    rings = [RingBuffer(INTENT) for _ in groups]
+    processes = [
+        context.Process(target=strategy_worker, args=(bot, shared, worker, ring, names, params), daemon=True)
+        for worker, (ring, names) in enumerate(zip(rings, groups))
+    ]
+    gateway = context.Process(target=order_gateway, args=(bot, shared, exchange, events, rings), daemon=True)
+    for process in processes + [gateway]:
+        process.start()
+
+    try:
+        while True:
+            exchange.wait(None)
+            for message in exchange.read_available():
+                kind = message["type"]
+                if kind == "book":
+                    shared.publish_book(message["symbol"], message["buy"], message["sell"])
+                elif kind in event_codes:
+                    symbol = symbol_codes.get(message.get("symbol"), 0)
+                    dir = dir_codes.get(message.get("dir"), 0)
+                    if kind == "fill":
+                        positions[message["symbol"]] += message["size"] if message["dir"] == Dir.BUY else -message["size"]
+                        shared.publish_positions(positions)
+                    while not events.push(
+                        event_codes[kind], symbol, dir, message.get("order_id", 0),
+                        message.get("price", 0), message.get("size", 0),
+                    ):
+                        time.sleep(idle_sleep)
+                    if kind == "close":
+                        print("The round has ended")
+                        gateway.join(1)
+                        return
+    finally:
+        for process in processes + [gateway]:
+            if process.is_alive():
+                process.terminate()
+        for ring in rings + [events]:
+            ring.close(unlink=True)
+        shared.close(unlink=True)
@@ -0,0 +1,121 @@
+from bisect import bisect_left, bisect_right
+from itertools import accumulate
+
+# What update() says happened to the top of the book, as bits. TOP_SIZE is
+# only set when both best prices stayed put but a size there moved.
+BID_PRICE, ASK_PRICE, TOP_SIZE = 1, 2, 4
+TOP_PRICE = BID_PRICE | ASK_PRICE
+
+
+def _index(levels, sign):
+    """(sort keys, sizes, running totals) for levels that arrive best first.
+    Bids get negated keys so both sides search in ascending order."""
+    return (
+        [sign * price for price, _ in levels],
+        [size for _, size in levels],
+        list(accumulate(size for _, size in levels)),
+    )
+
+
+class Book:
+    """Full depth order book for one symbol.
+
+    update() keeps the level lists of the book message as they are and reads
+    the best levels off their heads, so it costs the same however many
+    levels there are and however far apart they sit. Depth at a price and
+    cumulative size binary search a per side index with running totals,
+    built by the first such query after an update.
+
+    [seq] counts the updates that changed the top of the book and [changes]
+    holds the bits of the last update, so a consumer that remembers the seq
+    it last saw can skip a book whose best levels are where they were."""
+
+    __slots__ = (
+        "symbol", "bid", "ask", "bid_size", "ask_size", "buy", "sell",
+        "_bid_index", "_ask_index", "seq", "changes",
+    )
+
+    def __init__(self, symbol):
+        self.symbol = symbol
+        # Best prices and the size resting there, None when a side is empty
+        self.bid = None
+        self.ask = None
+        self.bid_size = 0
+        self.ask_size = 0
+        # Levels of the last book message, best first; never modified
+        self.buy = ()
+        self.sell = ()
+        self._bid_index = None
+        self._ask_index = None
+        self.seq = 0
+        self.changes = 0
+
+    def update(self, buy, sell):
+        """Replace both sides with the levels from an exchange book message.
+        Levels arrive best first as [price, size] pairs.
+        Returns the change bits for the top of the book, 0 if it is unchanged."""
+        bid, ask, bid_size, ask_size = self.bid, self.ask, self.bid_size, self.ask_size
+        self.buy = buy
+        self.sell = sell
+        self._bid_index = self._ask_index = None
+        if buy:
+            self.bid, self.bid_size = buy[0]
+        else:
+            self.bid, self.bid_size = None, 0
+        if sell:
+            self.ask, self.ask_size = sell[0]
+        else:
+            self.ask, self.ask_size = None, 0
+
+        changes = (BID_PRICE if self.bid != bid else 0) | (ASK_PRICE if self.ask != ask else 0)
+        if not changes and (self.bid_size != bid_size or self.ask_size != ask_size):
+            changes = TOP_SIZE
+        if changes:
+            self.seq += 1
+        self.changes = changes
+        return changes
+
+    def _bids(self):
+        if self._bid_index is None:
+            self._bid_index = _index(self.buy, -1)
+        return self._bid_index
+
+    def _asks(self):
+        if self._ask_index is None:
+            self._ask_index = _index(self.sell, 1)
+        return self._ask_index
+
+    def mid(self):
+        if self.bid is None or self.ask is None:
+            return None
+        return (self.bid + self.ask) // 2
+
+    def bid_depth(self, price):
+        """Size resting on the bid at exactly [price]"""
+        if self.bid is None or price > self.bid:
+            return 0
+        keys, sizes, _ = self._bids()
+        i = bisect_left(keys, -price)
+        return sizes[i] if i < len(keys) and keys[i] == -price else 0
+
+    def ask_depth(self, price):
+        """Size resting on the ask at exactly [price]"""
+        if self.ask is None or price < self.ask:
+            return 0
+        keys, sizes, _ = self._asks()
+        i = bisect_left(keys, price)
+        return sizes[i] if i < len(keys) and keys[i] == price else 0
+
+    def bid_cum_size(self, price):
+        """Total bid size at [price] or higher, i.e. what a sell at [price] could hit"""
+        if self.bid is None or price > self.bid:
+            return 0
+        keys, _, totals = self._bids()
+        return totals[bisect_right(keys, -price) - 1]
+
+    def ask_cum_size(self, price):
+        """Total ask size at [price] or lower, i.e. what a buy at [price] could lift"""
+        if self.ask is None or price < self.ask:
+            return 0
+        keys, _, totals = self._asks()
+        return totals[bisect_right(keys, price) - 1]
@@ -0,0 +1,201 @@
+from enum import Enum
+import os
+import threading
+
+from ratelimit import PRIORITY_QUOTE
+
+
+class OrderState(str, Enum):
+    PENDING = "PENDING"  # sent, no answer from the exchange yet
+    ACKED = "ACKED"
+    PARTIALLY_FILLED = "PARTIALLY_FILLED"
+    OUT = "OUT"  # left the book on its own, i.e. fully filled
+    REJECTED = "REJECTED"
+    CANCELLED = "CANCELLED"
+
+
+# Orders in these states are done and no longer tracked
+finished_states = {OrderState.OUT, OrderState.REJECTED, OrderState.CANCELLED}
+
+
+class Order:
+    __slots__ = ("order_id", "symbol", "dir", "price", "size", "filled", "state", "cancel_sent")
+
+    def __init__(self, order_id, symbol, dir, price, size):
+        self.order_id = order_id
+        self.symbol = symbol
+        self.dir = dir
+        self.price = price
+        self.size = size
+        self.filled = 0
+        self.state = OrderState.PENDING
+        self.cancel_sent = False
+
+    @property
+    def remaining(self):
+        return self.size - self.filled
+
+
+class OrderIdJournal:
+    """A file holding the highest order id we may have used, so a restarted bot
+    never sends an id the exchange has already seen this round.
+
+    Ids are reserved [block] at a time. The first block is written when the
+    journal is opened; after that, once ids pass [refill_at] (half way into
+    the reserved range) a background thread writes the next block, so the
+    trading thread never waits on fsync. It only blocks if it gets through a
+    whole half block before that write is done."""
+
+    def __init__(self, path, block=1000):
+        self.path = path
+        self.block = block
+        try:
+            with open(path) as f:
+                # Every id up to here may have been sent by an earlier run
+                self.first = int(f.read().strip() or 0)
+        except FileNotFoundError:
+            self.first = 0
+        # Durable on disk; ids up to it are safe to send
+        self.reserved = self.first + block
+        self._write(self.reserved)
+        # What the writer thread has been asked for
+        self.wanted = self.reserved
+        self.refill_at = self.reserved - block // 2
+        self.changed = threading.Condition()
+        self.writer = None
+
+    def advance(self, order_id):
+        """Called once [order_id] passes refill_at; returns when it is safe to send"""
+        with self.changed:
+            if order_id + self.block > self.wanted:
+                self.wanted = order_id + self.block
+                self.refill_at = self.wanted - self.block // 2
+                # Not carried over by a fork, so started by whoever uses ids first
+                if self.writer is None or not self.writer.is_alive():
+                    self.writer = threading.Thread(target=self._run, name="journal", daemon=True)
+                    self.writer.start()
+                self.changed.notify_all()
+            while order_id > self.reserved:
+                self.changed.wait()
+
+    def _run(self):
+        with self.changed:
+            while True:
+                while self.wanted == self.reserved:
+                    self.changed.wait()
+                wanted = self.wanted
+                self.changed.release()
+                try:
+                    self._write(wanted)
+                finally:
+                    self.changed.acquire()
+                self.reserved = wanted
+                self.changed.notify_all()
+
+    def _write(self, reserved):
+        temporary = self.path + ".tmp"
+        with open(temporary, "w") as f:
+            f.write("%d\n" % reserved)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, self.path)
+
+
+class OrderManager:
+    """Owns order ids and follows every order through ack, fill, out and reject.
+
+    Quoting strategies call quote() with the price and size they want resting
+    and the manager only touches the exchange when that actually changes."""
+
+    def __init__(self, first_order_id=0, journal=None):
+        # Carry on after whatever an earlier run may have used
+        self.last_order_id = max(first_order_id, journal.first) if journal is not None else first_order_id
+        self.journal = journal
+        # order_id -> Order, for orders that are still live
+        self.orders = {}
+        # (name, symbol, dir) -> Order currently standing for that quote
+        self.quotes = {}
+        self.rejects = 0
+
+    def next_order_id(self):
+        self.last_order_id += 1
+        if self.journal is not None and self.last_order_id > self.journal.refill_at:
+            self.journal.advance(self.last_order_id)
+        return self.last_order_id
+
+    def clear(self):
+        """Forget every order, e.g. once a reconnect has pulled them all. Ids keep counting."""
+        for order in self.orders.values():
+            order.state = OrderState.CANCELLED
+        self.orders.clear()
+        self.quotes.clear()
+
+    def send_add(self, exchange, symbol, dir, price, size, priority=PRIORITY_QUOTE):
+        order = Order(self.next_order_id(), symbol, dir, price, size)
+        self.orders[order.order_id] = order
+        if exchange.send_add_message(
+            order_id=order.order_id, symbol=symbol, dir=dir, price=price, size=size, priority=priority
+        ) is False:
+            # Stopped by the risk check before it left, as good as a reject
+            order.state = OrderState.REJECTED
+            del self.orders[order.order_id]
+        return order
+
+    def cancel(self, exchange, order):
+        if order.cancel_sent or order.state in finished_states:
+            return
+        order.cancel_sent = True
+        if exchange.send_cancel_message(order_id=order.order_id) is False:
+            # The add was still waiting for rate limit budget and never went out
+            order.state = OrderState.CANCELLED
+            del self.orders[order.order_id]
+
+    def quote(self, exchange, name, symbol, dir, price, size, priority=PRIORITY_QUOTE):
+        """Keep one order of [size] at [price] resting under [name].
+        A price of None or a size of 0 pulls the quote."""
+        key = (name, symbol, dir)
+        order = self.quotes.get(key)
+        if order is not None and order.state not in finished_states and not order.cancel_sent:
+            if order.price == price and order.size == size:
+                return order
+            self.cancel(exchange, order)
+        if price is None or size <= 0:
+            self.quotes.pop(key, None)
+            return None
+        order = self.quotes[key] = self.send_add(exchange, symbol, dir, price, size, priority)
+        return order
+
+    def pull(self, exchange, name):
+        """Cancel every quote standing under [name]"""
+        for key in [key for key in self.quotes if key[0] == name]:
+            self.cancel(exchange, self.quotes.pop(key))
+
+    def quoting(self, name, symbol, dir):
+        """True while the quote under [name] has a live order that is not being cancelled"""
+        order = self.quotes.get((name, symbol, dir))
+        return order is not None and order.state not in finished_states and not order.cancel_sent
+
+    def on_message(self, message):
+        kind = message["type"]
+        if kind == "ack":
+            order = self.orders.get(message["order_id"])
+            if order is not None and order.state == OrderState.PENDING:
+                order.state = OrderState.ACKED
+        elif kind == "fill":
+            order = self.orders.get(message["order_id"])
+            if order is not None:
+                order.filled += message["size"]
+                if order.filled >= order.size:
+                    order.state = OrderState.OUT
+                    del self.orders[order.order_id]
+                else:
+                    order.state = OrderState.PARTIALLY_FILLED
+        elif kind == "out":
+            order = self.orders.pop(message["order_id"], None)
+            if order is not None:
+                order.state = OrderState.CANCELLED if order.cancel_sent else OrderState.OUT
+        elif kind == "reject":
+            order = self.orders.pop(message["order_id"], None)
+            if order is not None:
+                order.state = OrderState.REJECTED
+                self.rejects += 1
@@ -0,0 +1,80 @@
+from collections import Counter
+from functools import wraps
+import os
+import sys
+import threading
+import time
+
+
+class StageProfiler:
+    """CPU time per stage of the main loop, counted by wrapping the functions involved"""
+
+    def __init__(self):
+        # name -> [calls, total thread CPU ns, worst call ns]
+        self.stages = {}
+
+    def wrap(self, name, function):
+        stats = self.stages.setdefault(name, [0, 0, 0])
+        cpu = time.thread_time_ns
+
+        @wraps(function)
+        def profiled(*args, **kwargs):
+            start = cpu()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                elapsed = cpu() - start
+                stats[0] += 1
+                stats[1] += elapsed
+                if elapsed > stats[2]:
+                    stats[2] = elapsed
+
+        return profiled
+
+    def report(self):
+        print("%-18s %9s %12s %12s %12s" % ("stage", "calls", "total ms", "per call us", "worst us"))
+        for name, (calls, total, worst) in sorted(self.stages.items(), key=lambda item: -item[1][1]):
+            print(
+                "%-18s %9d %12.1f %12.2f %12.1f"
+                % (name, calls, total / 1e6, total / calls / 1000 if calls else 0, worst / 1000)
+            )
+
+
+class StackSampler:
+    """Samples the main thread's stack from a background thread.
+
+    Stacks are counted in the collapsed format that flamegraph.pl and
+    speedscope read: one "outer;...;inner count" line per distinct stack."""
+
+    def __init__(self, path, interval=0.005, thread=None):
+        self.path = path
+        self.interval = interval
+        self.thread_id = (thread or threading.main_thread()).ident
+        self.samples = Counter()
+        self.stopped = threading.Event()
+        self.sampler = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+
+    def start(self):
+        self.sampler.start()
+        return self
+
+    def _run(self):
+        frames = sys._current_frames
+        while not self.stopped.wait(self.interval):
+            frame = frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append("%s:%s" % (os.path.basename(code.co_filename), code.co_name))
+                frame = frame.f_back
+            if stack:
+                self.samples[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        """Stop sampling and write the collapsed stacks file"""
+        self.stopped.set()
+        if self.sampler.is_alive():
+            self.sampler.join()
+        with open(self.path, "w") as f:
+            for stack, count in self.samples.most_common():
+                f.write("%s %d\n" % (stack, count))
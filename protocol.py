@@ -0,0 +1,213 @@
+from enum import Enum
+import json
+import re
+import struct
+import sys
+
+# Wire level pieces of the exchange protocol shared by the bot and its tools.
+
+symbols = ['BOND', 'VALBZ', 'VALE', 'GS', 'MS', 'WFC', 'XLF']
+
+
+class Dir(str, Enum):
+    BUY = "BUY"
+    SELL = "SELL"
+
+
+# Every symbol, direction and message type the exchange sends, interned once
+# so handlers compare against the same objects on every message.
+message_types = [
+    "hello", "open", "close", "error", "book", "trade", "ack", "reject", "fill", "out",
+]
+interned_symbols = {s: sys.intern(s) for s in symbols}
+interned_types = {t.encode(): sys.intern(t) for t in message_types}
+interned_type_names = {t: sys.intern(t) for t in message_types}
+interned_dirs = {"BUY": Dir.BUY, "SELL": Dir.SELL}
+
+# Market data that can be dropped before parsing when nobody wants the symbol
+market_data_types = {"book", "trade"}
+
+_type_field = re.compile(rb'"type"\s*:\s*"(\w+)"')
+# The exchange always writes the type first, so this nearly always matches
+_leading_type = re.compile(rb'\{\s*"type"\s*:\s*"(\w+)"')
+# Market data as the exchange writes it: type, then symbol. One match tells
+# the decoder whether to skip a line; anything else is simply parsed.
+_market_data_prefix = re.compile(rb'\{\s*"type"\s*:\s*"(?:book|trade)"\s*,\s*"symbol"\s*:\s*"(\w+)"')
+_symbol_field = re.compile(rb'"symbol"\s*:\s*"(\w+)"')
+# A whole book message as the exchange writes it. Each side is captured as
+# its raw JSON array plus the price and size of its first level; only
+# integers, commas, spaces and brackets may follow, anything else is parsed.
+_book_side = rb'(\[(?:\[\s*(-?\d+)\s*,\s*(-?\d+)\s*\][-\d\s,\[\]]*)?\])'
+_book = re.compile(
+    rb'\{\s*"type"\s*:\s*"book"\s*,\s*"symbol"\s*:\s*"(\w+)"\s*,\s*"buy"\s*:\s*' + _book_side
+    + rb'\s*,\s*"sell"\s*:\s*' + _book_side + rb'\s*\}\s*'
+)
+
+# Between the local gateway and its clients every message is a frame: its
+# length as a little endian uint32, then the JSON without a trailing newline.
+FRAME = struct.Struct("<I")
+
+
+def message_type(line):
+    """Interned type of an encoded message, found without parsing it (None if unknown)"""
+    match = _leading_type.match(line) or _type_field.search(line)
+    return interned_types.get(match.group(1)) if match else None
+
+
+def message_symbol(line):
+    """Symbol of an encoded message as bytes, found without parsing it (None if it has none)"""
+    match = _symbol_field.search(line)
+    return match.group(1) if match else None
+
+
+def frame(data):
+    """One encoded, newline terminated message as a gateway frame"""
+    return FRAME.pack(len(data) - 1) + data[:-1]
+
+
+class Levels:
+    """One side of a book message, best first, as a read only sequence of
+    [price, size] pairs. Only the best level is parsed up front; the rest of
+    the JSON array is kept as it came and parsed by the first look past it."""
+
+    __slots__ = ("head", "raw", "_levels")
+
+    def __init__(self, head, raw):
+        self.head = head
+        self.raw = raw
+        self._levels = None
+
+    def _parse(self):
+        levels = self._levels
+        if levels is None:
+            levels = self._levels = json.loads(self.raw)
+        return levels
+
+    def __bool__(self):
+        return self.head is not None
+
+    def __len__(self):
+        return len(self._parse())
+
+    def __getitem__(self, index):
+        if index == 0 and self.head is not None:
+            return self.head
+        return self._parse()[index]
+
+    def __iter__(self):
+        return iter(self._parse())
+
+    def __eq__(self, other):
+        return self._parse() == (other._parse() if isinstance(other, Levels) else other)
+
+    def __repr__(self):
+        return repr(self._parse())
+
+
+class Decoder:
+    """Decodes exchange lines, peeking at type and symbol before any JSON parsing.
+
+    Book and trade messages for symbols outside [subscribed] are skipped
+    without being parsed. A book in the shape the exchange writes it is
+    read by one regex match: its sides come back as Levels, so the depth
+    behind the best levels is only parsed if a handler asks for it.
+    Everything else is parsed and handed back with interned type/symbol
+    strings and Dir values; with every symbol subscribed, non-book lines
+    are not peeked at at all."""
+
+    def __init__(self, subscribed=None):
+        self.subscribed = set()
+        self.skipped = 0
+        self.filtering = True
+        for symbol in subscribed if subscribed is not None else symbols:
+            self.subscribe(symbol)
+
+    def subscribe(self, symbol):
+        self.subscribed.add(symbol.encode())
+        self.filtering = not self.subscribed.issuperset(s.encode() for s in symbols)
+
+    def unsubscribe(self, symbol):
+        self.subscribed.discard(symbol.encode())
+        self.filtering = True
+
+    def decode(self, line):
+        """Decode one line (bytes or a memoryview), returns None if it was skipped"""
+        match = _book.fullmatch(line)
+        if match is not None:
+            symbol, buy, bid, bid_size, sell, ask, ask_size = match.groups()
+            if symbol not in self.subscribed:
+                self.skipped += 1
+                return None
+            symbol = symbol.decode()
+            return {
+                "type": "book",
+                "symbol": interned_symbols.get(symbol, symbol),
+                "buy": Levels(None if bid is None else [int(bid), int(bid_size)], buy),
+                "sell": Levels(None if ask is None else [int(ask), int(ask_size)], sell),
+            }
+        if self.filtering:
+            match = _market_data_prefix.match(line)
+            if match is not None and match.group(1) not in self.subscribed:
+                self.skipped += 1
+                return None
+
+        # Straight from the buffer to str: json.loads would decode bytes anyway
+        message = json.loads(str(line, "utf-8"))
+        kind = message.get("type")
+        if kind is not None:
+            message["type"] = interned_type_names.get(kind, kind)
+        symbol = message.get("symbol")
+        if symbol is not None:
+            message["symbol"] = interned_symbols.get(symbol, symbol)
+        dir = message.get("dir")
+        if dir is not None:
+            message["dir"] = interned_dirs[dir]
+        return message
+
+
+# Outbound messages are formatted from cached byte templates, only the
+# numbers are filled in per order. Field order matches what json.dumps gives.
+_add_templates = {
+    (symbol, dir): (
+        '{"type": "add", "order_id": %%d, "symbol": "%s", "dir": "%s", "price": %%d, "size": %%d}\n'
+        % (symbol, dir)
+    ).encode()
+    for symbol in symbols
+    for dir in ("BUY", "SELL")
+}
+_convert_templates = {
+    (symbol, dir): (
+        '{"type": "convert", "order_id": %%d, "symbol": "%s", "dir": "%s", "size": %%d}\n'
+        % (symbol, dir)
+    ).encode()
+    for symbol in symbols
+    for dir in ("BUY", "SELL")
+}
+_cancel_template = b'{"type": "cancel", "order_id": %d}\n'
+
+
+def encode_message(message):
+    """Generic encoder for anything without a template"""
+    return json.dumps(message).encode() + b"\n"
+
+
+def encode_add(order_id, symbol, dir, price, size):
+    template = _add_templates.get((symbol, dir))
+    if template is None:
+        return encode_message(
+            {"type": "add", "order_id": order_id, "symbol": symbol, "dir": dir, "price": price, "size": size}
+        )
+    return template % (order_id, price, size)
+
+
+def encode_convert(order_id, symbol, dir, size):
+    template = _convert_templates.get((symbol, dir))
+    if template is None:
+        return encode_message(
+            {"type": "convert", "order_id": order_id, "symbol": symbol, "dir": dir, "size": size}
+        )
+    return template % (order_id, size)
+
+
+def encode_cancel(order_id):
+    return _cancel_template % order_id
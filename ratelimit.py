@@ -0,0 +1,85 @@
+from collections import deque
+
+# Lower numbers go out first
+PRIORITY_CANCEL = 0
+PRIORITY_REDUCE = 1  # orders that bring a position back towards flat
+PRIORITY_QUOTE = 2
+
+
+class Queued:
+    __slots__ = ("data", "key", "alive")
+
+    def __init__(self, data, key):
+        self.data = data
+        self.key = key
+        self.alive = True
+
+
+class RateLimiter:
+    """Token bucket in front of the exchange with one queue per priority.
+
+    The exchange allows [limit] messages in any one second window. A bucket
+    of [burst] tokens refilled at limit - burst per second can never exceed
+    that. Queued messages are released highest priority first, and a queued
+    add can be withdrawn before it is sent, so a superseded quote never costs
+    a message. Cancels are never dropped."""
+
+    def __init__(self, limit, burst=None):
+        if burst is None:
+            burst = max(limit // 5, 1)
+        self.burst = burst
+        self.rate = max(limit - burst, 1)
+        self.tokens = float(burst)
+        self.last_refill = None
+        self.queues = [deque(), deque(), deque()]
+        # key -> Queued, for messages that can still be withdrawn
+        self.withdrawable = {}
+        self.queued = 0
+
+    def submit(self, priority, data, key=None):
+        entry = Queued(data, key)
+        self.queues[priority].append(entry)
+        if key is not None:
+            self.withdrawable[key] = entry
+        self.queued += 1
+
+    def withdraw(self, key):
+        """Drop a message that has not been sent yet, returns True if it was still queued"""
+        entry = self.withdrawable.pop(key, None)
+        if entry is None:
+            return False
+        entry.alive = False
+        self.queued -= 1
+        return True
+
+    def clear(self):
+        """Drop everything queued, the budget already spent stays spent"""
+        for queue in self.queues:
+            queue.clear()
+        self.withdrawable.clear()
+        self.queued = 0
+
+    def release(self, now, write):
+        """Call write(data) for as many queued messages as the budget allows"""
+        if self.last_refill is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+        for queue in self.queues:
+            while queue and self.tokens >= 1:
+                entry = queue.popleft()
+                if not entry.alive:
+                    continue
+                if entry.key is not None:
+                    del self.withdrawable[entry.key]
+                self.tokens -= 1
+                self.queued -= 1
+                write(entry.data)
+            if queue:
+                # Out of tokens, lower priorities have to wait as well
+                break
+
+    def next_release(self):
+        """Seconds until the next queued message can go out, None if nothing is queued"""
+        if not self.queued:
+            return None
+        return max((1 - self.tokens) / self.rate, 0)
@@ -0,0 +1,112 @@
+from protocol import Dir
+
+# What the exchange enforces, counting every open order on the same side
+position_limits = {"BOND": 100, "VALBZ": 10, "VALE": 10, "GS": 100, "MS": 100, "WFC": 100, "XLF": 100}
+# A convert of 10 XLF is made up of these amounts of the underlying symbols
+xlf_basket = {"BOND": 3, "GS": 2, "MS": 3, "WFC": 2}
+
+POSITION, OPEN_BUY, OPEN_SELL, LIMIT = range(4)
+
+
+class RiskEngine:
+    """Pre-trade position check that mirrors the exchange's own.
+
+    Per symbol it keeps the filled position and the size still open on each
+    side, all updated incrementally from our sends and the exchange's
+    answers, so checking an order is a couple of dict lookups and additions.
+    An order that would let the worst case position (everything open on its
+    side filled) go past the limit is never sent, which saves the reject
+    round trip and the message it would have cost."""
+
+    def __init__(self, limits=None):
+        limits = dict(position_limits, **(limits or {}))
+        # symbol -> [position, open buy, open sell, limit]
+        self.symbols = {s: [0, 0, 0, limit] for s, limit in limits.items()}
+        # order_id -> [symbol entry, dir, remaining] for adds still open
+        self.orders = {}
+        # order_id -> [(symbol entry, change)] for converts waiting on an ack
+        self.converts = {}
+        self.blocked = 0
+
+    def reset(self, positions):
+        """Start again from [positions] with nothing open, e.g. from a hello message"""
+        for symbol, entry in self.symbols.items():
+            entry[POSITION] = positions.get(symbol, 0)
+            entry[OPEN_BUY] = entry[OPEN_SELL] = 0
+        self.orders.clear()
+        self.converts.clear()
+
+    def worst_case(self, symbol):
+        """(lowest, highest) position we could end up with if every open order filled"""
+        entry = self.symbols[symbol]
+        return entry[POSITION] - entry[OPEN_SELL], entry[POSITION] + entry[OPEN_BUY]
+
+    def check_add(self, order_id, symbol, dir, size):
+        """Reserve the exposure of a new order, or return False if it breaks the limit"""
+        entry = self.symbols[symbol]
+        if dir == Dir.BUY:
+            if entry[POSITION] + entry[OPEN_BUY] + size > entry[LIMIT]:
+                self.blocked += 1
+                return False
+            entry[OPEN_BUY] += size
+        else:
+            if entry[POSITION] - entry[OPEN_SELL] - size < -entry[LIMIT]:
+                self.blocked += 1
+                return False
+            entry[OPEN_SELL] += size
+        self.orders[order_id] = [entry, dir, size]
+        return True
+
+    def check_convert(self, order_id, symbol, dir, size):
+        """Reserve the position changes of a convert, or return False if any breaks a limit"""
+        sign = 1 if dir == Dir.BUY else -1
+        if symbol in ("VALE", "VALBZ"):
+            other = "VALBZ" if symbol == "VALE" else "VALE"
+            changes = [(symbol, sign * size), (other, -sign * size)]
+        else:
+            changes = [(symbol, sign * size)]
+            changes += [(s, -sign * weight * size // 10) for s, weight in xlf_basket.items()]
+        changes = [(self.symbols[s], change) for s, change in changes]
+        for entry, change in changes:
+            if change > 0 and entry[POSITION] + entry[OPEN_BUY] + change > entry[LIMIT]:
+                self.blocked += 1
+                return False
+            if change < 0 and entry[POSITION] - entry[OPEN_SELL] + change < -entry[LIMIT]:
+                self.blocked += 1
+                return False
+        # Held as open exposure until the exchange says yes or no
+        for entry, change in changes:
+            entry[OPEN_BUY if change > 0 else OPEN_SELL] += abs(change)
+        self.converts[order_id] = changes
+        return True
+
+    def release(self, order_id):
+        """Give back what an order reserved when it never reaches the exchange"""
+        order = self.orders.pop(order_id, None)
+        if order is not None:
+            order[0][OPEN_BUY if order[1] == Dir.BUY else OPEN_SELL] -= order[2]
+            return
+        for entry, change in self.converts.pop(order_id, ()):
+            entry[OPEN_BUY if change > 0 else OPEN_SELL] -= abs(change)
+
+    def on_message(self, message):
+        kind = message["type"]
+        if kind == "fill":
+            entry = self.symbols[message["symbol"]]
+            size = message["size"]
+            buy = message["dir"] == Dir.BUY
+            entry[POSITION] += size if buy else -size
+            order = self.orders.get(message["order_id"])
+            if order is not None:
+                entry[OPEN_BUY if buy else OPEN_SELL] -= size
+                order[2] -= size
+                if order[2] <= 0:
+                    del self.orders[message["order_id"]]
+        elif kind == "ack":
+            changes = self.converts.pop(message["order_id"], None)
+            if changes is not None:
+                for entry, change in changes:
+                    entry[OPEN_BUY if change > 0 else OPEN_SELL] -= abs(change)
+                    entry[POSITION] += change
+        elif kind == "out" or kind == "reject":
+            self.release(message["order_id"])
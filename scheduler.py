@@ -0,0 +1,104 @@
+import heapq
+import time
+
+
+class Job:
+    __slots__ = (
+        "name", "callback", "args", "period", "due", "cancelled", "runs", "missed", "max_late",
+    )
+
+    def __init__(self, name, callback, args, period, due):
+        self.name = name
+        self.callback = callback
+        self.args = args
+        # None for one-shot jobs
+        self.period = period
+        self.due = due
+        self.cancelled = False
+        self.runs = 0
+        # Whole periods that were skipped because the loop was too busy
+        self.missed = 0
+        self.max_late = 0.0
+
+
+class Scheduler:
+    """Runs periodic and one-shot jobs off a heap of deadlines.
+
+    The clock is read once per run_due() call and every job due at that
+    moment runs against the same timestamp. Periodic jobs keep their phase:
+    the next deadline is the previous one plus the period, never "now" plus
+    the period, so they do not drift."""
+
+    def __init__(self, clock=time.monotonic, latency=None):
+        self.clock = clock
+        # Optional LatencyTracker that gets the run time of every job
+        self.latency = latency
+        self.now = clock()
+        self.heap = []
+        # Periodic jobs, kept for report()
+        self.jobs = []
+        self.sequence = 0
+
+    def every(self, period, callback, *args, offset=0, name=None):
+        """Call callback(*args) every [period] seconds, the first time after period + offset"""
+        job = Job(name or callback.__name__, callback, args, period, self.now + period + offset)
+        self.jobs.append(job)
+        return self._push(job)
+
+    def after(self, delay, callback, *args, name=None):
+        """Call callback(*args) once, [delay] seconds from now"""
+        return self._push(Job(name or callback.__name__, callback, args, None, self.now + delay))
+
+    def cancel(self, job):
+        # Cancelled jobs are dropped lazily when they reach the top of the heap
+        job.cancelled = True
+        if job in self.jobs:
+            self.jobs.remove(job)
+
+    def _push(self, job):
+        self.sequence += 1
+        heapq.heappush(self.heap, (job.due, self.sequence, job))
+        return job
+
+    def next_deadline(self):
+        """Clock time of the earliest pending job, None if nothing is scheduled"""
+        heap = self.heap
+        while heap and heap[0][2].cancelled:
+            heapq.heappop(heap)
+        return heap[0][0] if heap else None
+
+    def run_due(self):
+        """Run every job whose deadline has passed.
+        Returns the seconds until the next deadline, or None if nothing is scheduled."""
+        now = self.now = self.clock()
+        heap = self.heap
+        while heap and heap[0][0] <= now:
+            due, _, job = heapq.heappop(heap)
+            if job.cancelled:
+                continue
+            late = now - due
+            if late > job.max_late:
+                job.max_late = late
+            job.runs += 1
+            if self.latency is None:
+                job.callback(*job.args)
+            else:
+                start = time.perf_counter_ns()
+                job.callback(*job.args)
+                self.latency.record("strategy", job.name, time.perf_counter_ns() - start)
+            if job.period is not None and not job.cancelled:
+                skipped = int(late // job.period)
+                job.missed += skipped
+                job.due = due + (skipped + 1) * job.period
+                self.sequence += 1
+                heapq.heappush(heap, (job.due, self.sequence, job))
+        if not heap:
+            return None
+        return max(heap[0][0] - now, 0)
+
+    def report(self):
+        for job in self.jobs:
+            print(
+                "%-16s runs %7d  missed %6d  max late %.3f ms"
+                % (job.name, job.runs, job.missed, job.max_late * 1000)
+            )
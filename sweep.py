@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+
+# ~~~~~============== PARAMETER SWEEP ==============~~~~~
+# Backtests many strategy parameter sets over the same sessions on every core
+# and ranks them.
+#
+#   ./sweep.py --capture a.cap --capture b.cap \
+#       --grid XLF_trade.margin=2:20:2 --grid XLF_balance.safeguard=20,50,80
+#   ./sweep.py --synthetic 60 --sessions 4 --grid XLF_trade.period=0.005,0.01,0.02 --random 500
+#
+# Sessions are decoded once, packed into shared memory and unpacked once per
+# worker process, so each configuration only pays for its own backtest.
+
+from array import array
+import argparse
+import itertools
+from multiprocessing import Pool, shared_memory
+import os
+import random
+import struct
+import time
+
+import backtest
+from protocol import symbols
+
+# ts, kind (0 book, 1 trade), symbol, buy levels, sell levels, then
+# (price, size) int32 pairs; a trade is stored as a single buy level
+RECORD = struct.Struct("<dBBHH")
+LEVEL_BYTES = 8
+
+symbol_codes = {s: i for i, s in enumerate(symbols)}
+
+
+def pack_session(session):
+    """Market data of a session as one compact bytes object"""
+    out = bytearray()
+    levels = array("i")
+    for ts, message in session:
+        symbol = symbol_codes[message["symbol"]]
+        del levels[:]
+        if message["type"] == "book":
+            out += RECORD.pack(ts, 0, symbol, len(message["buy"]), len(message["sell"]))
+            for price, size in message["buy"]:
+                levels.append(price)
+                levels.append(size)
+            for price, size in message["sell"]:
+                levels.append(price)
+                levels.append(size)
+        else:
+            out += RECORD.pack(ts, 1, symbol, 1, 0)
+            levels.append(message["price"])
+            levels.append(message["size"])
+        out += levels.tobytes()
+    return bytes(out)
+
+
+def unpack_session(buffer):
+    """Inverse of pack_session; [buffer] may be bytes or a memoryview of shared memory"""
+    session = []
+    offset = 0
+    end = len(buffer)
+    while offset < end:
+        ts, kind, symbol, buy_n, sell_n = RECORD.unpack_from(buffer, offset)
+        offset += RECORD.size
+        # frombytes, since array("i", memoryview) would take every byte as an element
+        levels = array("i")
+        levels.frombytes(buffer[offset:offset + (buy_n + sell_n) * LEVEL_BYTES])
+        levels = levels.tolist()
+        offset += (buy_n + sell_n) * LEVEL_BYTES
+        if kind == 0:
+            buy = [levels[i:i + 2] for i in range(0, 2 * buy_n, 2)]
+            sell = [levels[i:i + 2] for i in range(2 * buy_n, 2 * (buy_n + sell_n), 2)]
+            session.append((ts, {"type": "book", "symbol": symbols[symbol], "buy": buy, "sell": sell}))
+        else:
+            session.append(
+                (ts, {"type": "trade", "symbol": symbols[symbol], "price": levels[0], "size": levels[1]})
+            )
+    return session
+
+
+class SharedSessions:
+    """Packed sessions in shared memory blocks that worker processes attach to by name"""
+
+    def __init__(self, sessions):
+        self.blocks = []
+        for session in sessions:
+            packed = pack_session(session)
+            block = shared_memory.SharedMemory(create=True, size=max(len(packed), 1))
+            block.buf[:len(packed)] = packed
+            self.blocks.append((block, len(packed)))
+
+    def handles(self):
+        return [(block.name, size) for block, size in self.blocks]
+
+    def check(self, sessions):
+        """Raise unless every block, read the way a worker reads it, unpacks to
+        the same market data as the session packed to plain bytes"""
+        for (block, size), session in zip(self.blocks, sessions):
+            if unpack_session(block.buf[:size]) != unpack_session(pack_session(session)):
+                raise ValueError("A session did not survive packing into shared memory")
+
+    def close(self):
+        for block, _ in self.blocks:
+            block.close()
+            block.unlink()
+
+
+# Filled in by each worker process before it runs anything
+worker_sessions = None
+worker_latency = None
+
+
+def attach(handles, latency):
+    global worker_sessions, worker_latency
+    worker_sessions = []
+    for name, size in handles:
+        block = shared_memory.SharedMemory(name=name)
+        worker_sessions.append(unpack_session(block.buf[:size]))
+        block.close()
+    worker_latency = latency
+
+
+def evaluate(job):
+    """Backtest one configuration over every session and add the results up"""
+    index, params = job
+    total = {"pnl": 0, "fills": 0, "messages": 0, "rejects": 0, "max_position": 0}
+    for session in worker_sessions:
+        result = backtest.run_backtest(session, params, backtest.LatencyModel(*worker_latency))
+        for key in ("pnl", "fills", "messages", "rejects"):
+            total[key] += result[key]
+        total["max_position"] = max(total["max_position"], result["max_position"])
+    return index, params, total
+
+
+# ~~~~~============== SEARCH SPACE ==============~~~~~
+
+def parse_value(text):
+    return float(text) if "." in text else int(text)
+
+
+def parse_axis(setting):
+    """"XLF_trade.margin=5,10,15" or "XLF_trade.margin=2:20:2" (stop included)"""
+    name, _, values = setting.partition("=")
+    strategy, _, key = name.partition(".")
+    if not key or not values:
+        raise argparse.ArgumentTypeError("expected STRATEGY.PARAM=VALUES, got %r" % setting)
+    if ":" in values:
+        start, stop, step = (parse_value(v) for v in values.split(":"))
+        count = int(round((stop - start) / step)) + 1
+        values = [start + i * step for i in range(count)]
+        if isinstance(step, float):
+            values = [round(v, 9) for v in values]
+    else:
+        values = [parse_value(v) for v in values.split(",")]
+    return strategy, key, values
+
+
+def configurations(axes, samples=None, seed=0):
+    """Every point of the grid, or [samples] random points of it"""
+    def to_params(point):
+        params = {}
+        for (strategy, key, _), value in zip(axes, point):
+            params.setdefault(strategy, {})[key] = value
+        return params
+
+    if samples is None:
+        return [to_params(point) for point in itertools.product(*(values for _, _, values in axes))]
+    rnd = random.Random(seed)
+    return [to_params([rnd.choice(values) for _, _, values in axes]) for _ in range(samples)]
+
+
+def describe(params):
+    return " ".join(
+        "%s.%s=%s" % (strategy, key, value)
+        for strategy, settings in sorted(params.items())
+        for key, value in sorted(settings.items())
+    ) or "(defaults)"
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Sweep strategy parameters over recorded sessions.")
+    session_group = parser.add_mutually_exclusive_group(required=True)
+    session_group.add_argument(
+        "--capture", type=str, action="append", metavar="PATH", help="A capture file to replay; repeat for more."
+    )
+    session_group.add_argument("--synthetic", type=float, metavar="SECONDS", help="Replay synthetic sessions.")
+    parser.add_argument("--sessions", type=int, default=1, help="Number of synthetic sessions.")
+    parser.add_argument("--rate", type=float, default=1000, help="Book messages per second in synthetic sessions.")
+    parser.add_argument(
+        "--grid", type=parse_axis, action="append", default=[], metavar="STRATEGY.PARAM=VALUES",
+        help="Values to try, as a,b,c or start:stop:step.",
+    )
+    parser.add_argument("--random", type=int, metavar="N", help="Try N random points of the grid instead of all of it.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--latency-ms", type=float, default=1.0, help="One way latency to the exchange.")
+    parser.add_argument("--jitter-ms", type=float, default=0.0, help="Uniform extra latency.")
+    parser.add_argument("--processes", type=int, default=os.cpu_count(), help="Worker processes.")
+    parser.add_argument("--top", type=int, default=20, help="Rows of the ranking to print.")
+    parser.add_argument(
+        "--check-sessions", action="store_true",
+        help="Debugging: check that every session reads back intact from shared memory first.",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    if args.capture:
+        sessions = [backtest.load_capture(path) for path in args.capture]
+    else:
+        sessions = [
+            backtest.synthetic_session(args.synthetic, rate=args.rate, seed=args.seed + i)
+            for i in range(args.sessions)
+        ]
+    jobs = list(enumerate(configurations(args.grid, args.random, args.seed)))
+    latency = (args.latency_ms / 1000, args.jitter_ms / 1000, args.seed)
+
+    shared = SharedSessions(sessions)
+    results = []
+    start = time.perf_counter()
+    try:
+        if args.check_sessions:
+            shared.check(sessions)
+        with Pool(args.processes, initializer=attach, initargs=(shared.handles(), latency)) as pool:
+            for done, result in enumerate(pool.imap_unordered(evaluate, jobs), 1):
+                results.append(result)
+                print("\r%d/%d configurations" % (done, len(jobs)), end="", flush=True)
+    finally:
+        shared.close()
+    elapsed = time.perf_counter() - start
+    print()
+
+    results.sort(key=lambda result: -result[2]["pnl"])
+    print("%4s %10s %7s %9s %8s %7s  %s" % ("rank", "pnl", "fills", "messages", "rejects", "max pos", "parameters"))
+    for rank, (_, params, total) in enumerate(results[:args.top], 1):
+        print(
+            "%4d %10d %7d %9d %8d %7d  %s"
+            % (rank, total["pnl"], total["fills"], total["messages"], total["rejects"],
+               total["max_position"], describe(params))
+        )
+    print("%d configurations x %d sessions in %.1fs" % (len(jobs), len(sessions), elapsed))
+
+
+if __name__ == "__main__":
+    main()
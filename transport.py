@@ -0,0 +1,122 @@
+import socket
+import time
+
+from protocol import FRAME
+
+receive_buffer_size = 1 << 20
+socket_receive_buffer = 4 << 20
+socket_send_buffer = 1 << 20
+
+
+class Transport:
+    """Message oriented socket transport that never decodes or copies on receive.
+
+    Bytes are received straight into one preallocated bytearray with
+    recv_into, and complete messages are handed out by records() as
+    memoryview slices of it: newline delimited lines from the exchange, or
+    length prefixed frames when [framed] (the local gateway). A slice is only
+    valid until the next call to fill(), so consumers must be done with it
+    (or copy it) before reading again."""
+
+    def __init__(self, sock, capacity=receive_buffer_size, blocking=True, framed=False):
+        self.sock = sock
+        self.buffer = bytearray(capacity)
+        self.view = memoryview(self.buffer)
+        # Unconsumed data lives in buffer[start:end]
+        self.start = 0
+        self.end = 0
+        self.out = bytearray()
+        self.blocking = blocking
+        # perf_counter_ns() of the last recv that returned data
+        self.recv_ns = 0
+        self.records = self.frames if framed else self.lines
+
+        if sock.family in (socket.AF_INET, socket.AF_INET6):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, socket_receive_buffer)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, socket_send_buffer)
+        if not blocking:
+            sock.setblocking(False)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def fill(self):
+        """Receive whatever the socket has into the buffer.
+        Returns the number of bytes read, 0 if a non-blocking socket had nothing."""
+        if self.end == len(self.buffer):
+            self._make_room()
+        try:
+            n = self.sock.recv_into(self.view[self.end:])
+        except (BlockingIOError, InterruptedError):
+            return 0
+        if n == 0:
+            raise ConnectionError("The exchange closed the connection")
+        self.recv_ns = time.perf_counter_ns()
+        self.end += n
+        return n
+
+    def _make_room(self):
+        pending = self.end - self.start
+        if self.start == 0:
+            # One line fills the whole buffer, move to a bigger one
+            buffer = bytearray(2 * len(self.buffer))
+            buffer[:pending] = self.buffer
+            self.buffer = buffer
+            self.view = memoryview(buffer)
+        else:
+            self.buffer[:pending] = self.buffer[self.start:self.end]
+        self.start = 0
+        self.end = pending
+
+    def lines(self):
+        """Yield every complete line received so far as a memoryview"""
+        find = self.buffer.find
+        view = self.view
+        while True:
+            start = self.start
+            newline = find(b"\n", start, self.end)
+            if newline < 0:
+                break
+            self.start = newline + 1
+            if newline > start:
+                yield view[start:newline]
+        if self.start == self.end:
+            self.start = self.end = 0
+
+    def frames(self):
+        """Yield every complete frame received so far as a memoryview"""
+        buffer = self.buffer
+        view = self.view
+        header = FRAME.size
+        while self.end - self.start >= header:
+            start = self.start + header
+            (length,) = FRAME.unpack_from(buffer, self.start)
+            if self.end - start < length:
+                break
+            self.start = start + length
+            yield view[start:self.start]
+        if self.start == self.end:
+            self.start = self.end = 0
+
+    def send(self, data):
+        """Blocking: send all of [data] now. Non-blocking: queue it for the next flush(),
+        so everything written in one loop iteration goes out in one syscall."""
+        if self.blocking:
+            self.sock.sendall(data)
+            return
+        self.out += data
+
+    def flush(self):
+        """Send as much queued output as the socket takes, returns True once empty"""
+        if not self.out:
+            return True
+        try:
+            sent = self.sock.send(self.out)
+        except (BlockingIOError, InterruptedError):
+            return False
+        del self.out[:sent]
+        return not self.out
+
+    def close(self):
+        self.sock.close()